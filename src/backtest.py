@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import sys
+import time
+import traceback
+from typing import Dict
+import numpy as np
+import yaml
+from compute import PMaxEntry
+from kline_archive import read_archive
+from kline_store import KlineStore
+from log import logger
+from okex import (
+    MetadataCache,
+    POS_SIDE_LONG,
+    SIDE_BUY,
+)
+from pmax import CMO_LENGTH
+from task import Task
+
+DEFAULT_FEE_RATE = 0.0005
+DEFAULT_SLIPPAGE = 0.0
+DEFAULT_FUNDING_RATE = 0.0001
+FUNDING_INTERVAL_MS = 8 * 3600 * 1000
+DEFAULT_INSTRUMENT = {
+    "tickSz": "0.001",
+    "lotSz": "1",
+    "minSz": "1",
+    "ctVal": "1",
+    "lever": "10",
+}
+
+
+class SimulatedFeed:
+    """Stands in for MarketFeed: always live, ticker from the current bar."""
+
+    def __init__(self, exchange: "SimulatedOKEX") -> None:
+        self.exchange = exchange
+
+    def live(self, instId: str, bar: str) -> bool:
+        return True
+
+    def ticker(self, instId: str) -> dict:
+        return self.exchange.tickers[instId]
+
+
+class SimulatedAccount:
+    """Stands in for AccountFeed: orders are final as soon as they are placed."""
+
+    live = True
+
+    def __init__(self, exchange: "SimulatedOKEX") -> None:
+        self.exchange = exchange
+
+    def position(self, instId: str) -> dict:
+        for position in self.exchange.positions[instId].values():
+            if position["pos"] != "0":
+                return position
+        return None
+
+    async def wait_order(self, ordId: str, timeout: float) -> dict:
+        return self.exchange.orders.get(ordId)
+
+
+class SimulatedOKEX:
+    """The part of OKEX a Task uses, filled from replayed candles.
+
+    Orders fill immediately at their limit price moved against us by
+    `slippage`, paying `fee_rate` of the notional. Open positions pay (long)
+    or receive (short) `funding_rate` of their notional every 8 hours.
+    """
+
+    def __init__(
+        self,
+        instruments: Dict[str, dict],
+        fee_rate: float = DEFAULT_FEE_RATE,
+        slippage: float = DEFAULT_SLIPPAGE,
+        funding_rate: float = DEFAULT_FUNDING_RATE,
+    ) -> None:
+        self.instruments = {
+            instId: {**DEFAULT_INSTRUMENT, **inst, "instId": instId}
+            for instId, inst in instruments.items()
+        }
+        self.fee_rate = fee_rate
+        self.slippage = slippage
+        self.funding_rate = funding_rate
+        self.testnet = False
+        self.metadata = MetadataCache(self)
+        self.feed = SimulatedFeed(self)
+        self.account = SimulatedAccount(self)
+
+        self.tickers: Dict[str, dict] = {}
+        self.orders: Dict[str, dict] = {}
+        self.next_ordId = 1
+        self.positions: Dict[str, Dict[str, dict]] = {}
+        self.stats: Dict[str, dict] = {}
+        for instId in self.instruments:
+            self.positions[instId] = {}
+            self.stats[instId] = {
+                "trades": 0,
+                "realized": 0.0,
+                "fees": 0.0,
+                "funding": 0.0,
+                "equity": 0.0,
+                "peak": 0.0,
+                "max_drawdown": 0.0,
+                "last_funding": None,
+            }
+
+    def set_bar(self, instId: str, open_time: int, close: float, bar_ms: int):
+        tick = float(self.instruments[instId]["tickSz"])
+        self.tickers[instId] = {
+            "instId": instId,
+            "last": close,
+            "bidPx": close - tick,
+            "askPx": close + tick,
+        }
+        close_time = open_time + bar_ms
+        period = close_time // FUNDING_INTERVAL_MS
+        stats = self.stats[instId]
+        if stats["last_funding"] is not None and period > stats["last_funding"]:
+            ctVal = float(self.instruments[instId]["ctVal"])
+            for position in self.positions[instId].values():
+                notional = float(position["pos"]) * ctVal * close
+                sign = -1 if position["posSide"] == POS_SIDE_LONG else 1
+                stats["funding"] += sign * notional * self.funding_rate
+        stats["last_funding"] = period
+
+    def mark(self, instId: str, close: float):
+        """Update equity and drawdown at the bar's close."""
+        stats = self.stats[instId]
+        ctVal = float(self.instruments[instId]["ctVal"])
+        unrealized = 0.0
+        for position in self.positions[instId].values():
+            sign = 1 if position["posSide"] == POS_SIDE_LONG else -1
+            unrealized += (
+                sign
+                * (close - float(position["avgPx"]))
+                * float(position["pos"])
+                * ctVal
+            )
+        equity = stats["realized"] - stats["fees"] + stats["funding"] + unrealized
+        stats["equity"] = equity
+        stats["peak"] = max(stats["peak"], equity)
+        stats["max_drawdown"] = max(stats["max_drawdown"], stats["peak"] - equity)
+
+    def report(self, instId: str) -> dict:
+        stats = self.stats[instId]
+        return {
+            "pnl": stats["equity"],
+            "realized": stats["realized"],
+            "fees": stats["fees"],
+            "funding": stats["funding"],
+            "trades": stats["trades"],
+            "max_drawdown": stats["max_drawdown"],
+        }
+
+    def __fill(self, instId: str, side: str, sz: float, posSide: str, px: float):
+        stats = self.stats[instId]
+        ctVal = float(self.instruments[instId]["ctVal"])
+        px = px * (1 + self.slippage) if side == SIDE_BUY else px * (1 - self.slippage)
+        stats["fees"] += px * sz * ctVal * self.fee_rate
+        stats["trades"] += 1
+        opening = (side == SIDE_BUY) == (posSide == POS_SIDE_LONG)
+        position = self.positions[instId].get(posSide)
+        pos = float(position["pos"]) if position is not None else 0.0
+        if opening:
+            avgPx = float(position["avgPx"]) if position is not None else px
+            avgPx = (avgPx * pos + px * sz) / (pos + sz)
+            pos += sz
+        else:
+            sz = min(sz, pos)
+            avgPx = float(position["avgPx"])
+            sign = 1 if posSide == POS_SIDE_LONG else -1
+            stats["realized"] += sign * (px - avgPx) * sz * ctVal
+            pos -= sz
+        if pos <= 0:
+            self.positions[instId].pop(posSide, None)
+            return
+        self.positions[instId][posSide] = {
+            "instId": instId,
+            "posSide": posSide,
+            "pos": str(pos),
+            "availPos": str(pos),
+            "avgPx": str(avgPx),
+        }
+
+    async def get_instruments(self, instType: str, uly: str = None, instId: str = None):
+        return {"code": "0", "data": list(self.instruments.values())}
+
+    async def get_leverage_info(self, instId: str, mgnMode: str):
+        return {"code": "0", "data": [{"lever": self.instruments[instId]["lever"]}]}
+
+    async def set_leverage(self, instId: str, lever: str, mgnMode: str, **kwargs):
+        self.instruments[instId]["lever"] = lever
+        return {"code": "0", "data": [{"lever": lever}]}
+
+    async def get_ticker(self, instId: str):
+        return {"code": "0", "data": [self.tickers[instId]]}
+
+    async def get_positions(self, instType: str = None, instId: str = None, **kwargs):
+        position = self.account.position(instId)
+        return {"code": "0", "data": [] if position is None else [position]}
+
+    async def order_coalesced(
+        self,
+        instId: str,
+        tdMode: str,
+        side: str,
+        ordType: str,
+        sz: str,
+        posSide: str = None,
+        px: str = None,
+    ) -> dict:
+        ordId = str(self.next_ordId)
+        self.next_ordId += 1
+        px = float(px) if px is not None else self.tickers[instId]["last"]
+        self.__fill(instId, side, float(sz), posSide, px)
+        self.orders = {ordId: {"ordId": ordId, "state": "filled"}}
+        return {"ordId": ordId, "sCode": "0", "sMsg": ""}
+
+    async def cancel_order_coalesced(self, instId: str, ordId: str = None, **kwargs):
+        return {"ordId": ordId, "sCode": "0", "sMsg": ""}
+
+    async def get_order(self, instId: str = None, ordId: str = None):
+        return {"code": "0", "data": [self.orders[ordId]]}
+
+
+async def backtest_task(
+    task_config: dict,
+    candles: Dict[str, np.ndarray],
+    instrument: dict = None,
+    **exchange_config,
+) -> dict:
+    """Replay candles (archive columns, oldest first) through one Task."""
+    instId = task_config["id"]
+    exchange = SimulatedOKEX({instId: instrument or {}}, **exchange_config)
+    task = Task(
+        client=exchange,
+        inst_type=task_config["inst_type"],
+        id=instId,
+        bar=task_config["bar"],
+        mal=task_config["mal"],
+        atrm=task_config["atrm"],
+        atrl=task_config["atrl"],
+        sz=task_config["sz"],
+        feed=exchange.feed,
+        account=exchange.account,
+        archive=False,
+    )
+    task.klines = KlineStore()
+    task.pmax = PMaxEntry()
+    await task.asyncinit()
+
+    columns = [
+        np.asarray(candles[name], dtype=np.float64)
+        for name in ("Open Time", "Open", "High", "Low", "Close", "Volume", "VolumeCcy")
+    ]
+    ot = columns[0]
+    close = columns[4].tolist()
+    n = len(ot)
+    # Task.run() would log and skip a failing bar; count those instead, so
+    # a broken decision or order path cannot pass for a quiet market.
+    errors = 0
+    start = time.perf_counter()
+    for i in range(n):
+        exchange.set_bar(instId, int(ot[i]), close[i], task.barms)
+        task.klines.append([c[i] for c in columns] + [0.0, 1.0])
+        if i > CMO_LENGTH:
+            try:
+                await task.step()
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    logger.error(str(e) + str(traceback.format_exc()))
+        exchange.mark(instId, close[i])
+    elapsed = time.perf_counter() - start
+
+    report = exchange.report(instId)
+    report["errors"] = errors
+    report["bars"] = n
+    report["seconds"] = elapsed
+    return report
+
+
+async def main(config_path: str = "config.yaml"):
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    backtest_config = config.get("backtest", {})
+    instruments = backtest_config.get("instruments", {})
+    exchange_config = {
+        key: backtest_config[key]
+        for key in ("fee_rate", "slippage", "funding_rate")
+        if key in backtest_config
+    }
+    logger.setLevel(logging.INFO)
+    for item in config["task_list"]:
+        task_config = {
+            key: item.get(key, config.get(key))
+            for key in ("id", "inst_type", "bar", "mal", "atrm", "atrl", "sz")
+        }
+        candles = read_archive(task_config["id"], task_config["bar"])
+        report = await backtest_task(
+            task_config,
+            candles,
+            instruments.get(task_config["id"]),
+            **exchange_config,
+        )
+        print(
+            f"{task_config['id']}/{task_config['bar']}: "
+            + ", ".join(
+                f"{k} {v:.4f}" if isinstance(v, float) else f"{k} {v}"
+                for k, v in report.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*sys.argv[1:]))
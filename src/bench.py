@@ -0,0 +1,369 @@
+import asyncio
+import base64
+from datetime import datetime
+import hmac
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import sys
+import tempfile
+import time
+import warnings
+
+from aiohttp import web
+import numpy as np
+import pandas as pd
+from ta.trend import ADXIndicator, EMAIndicator
+from ta.volatility import AverageTrueRange
+
+from indicators import ADX, ATR, EMA
+from kline_store import kline_store
+from log import TelegramHandler
+from mock_okx import MockOKX
+from okex import OKEX
+from okex_ws import MarketFeed
+from pmax import PMax, pmax, pmax_batch
+from precision import ROUND_DOWN, Precision
+from task import round_step_size
+
+
+def make_candles(n: int, seed: int = 0):
+    """Deterministic random-walk high/low/close fixture."""
+    rng = np.random.default_rng(seed)
+    close = 100 + np.cumsum(rng.normal(0, 1, n))
+    high = close + rng.random(n)
+    low = close - rng.random(n)
+    # A flat stretch exercises the 0/0 CMO path.
+    flat = slice(n // 2, n // 2 + min(20, n // 10))
+    high[flat], low[flat], close[flat] = 101.0, 99.0, 100.0
+    return high, low, close
+
+
+def check_pmax_batch():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for seed, (atrl, atrm, mal) in enumerate(
+            [(3, 1, 5), (10, 3, 10), (14, 2.5, 7)]
+        ):
+            high, low, close = make_candles(1000, seed)
+            want = pmax(
+                pd.Series(high), pd.Series(low), pd.Series(close), atrl, atrm, mal
+            )
+            got = pmax_batch(high, low, close, atrl, atrm, mal)
+            for name, w, g in zip(("PMax", "MA", "dir", "src"), want, got):
+                w = w.astype(float).to_numpy()
+                if not np.allclose(w, g, rtol=1e-12, atol=0, equal_nan=True):
+                    raise AssertionError(f"pmax_batch {name} differs from pmax")
+    check_pmax_flat()
+    print("pmax_batch matches pmax")
+
+
+def check_pmax_flat():
+    """A flat stretch, then movement again: the MA has to recover, and the
+    incremental PMax has to agree with the batch one all along."""
+    high, low, close = make_candles(3000, 1)
+    pm, ma, dir, _ = pmax_batch(high, low, close, 10, 3, 10)
+    flat_end = 1500 + 20
+    if np.isnan(ma[flat_end:]).any() or np.isnan(pm[flat_end:]).any():
+        raise AssertionError("pmax_batch MA stays nan after a flat stretch")
+    state = PMax(10, 3, 10)
+    values = state.seed(high[:1000], low[:1000], close[:1000])
+    values += [state.update(*bar) for bar in zip(high[1000:], low[1000:], close[1000:])]
+    got = np.array([v[1] for v in values])
+    if not np.array_equal(got, ma):
+        raise AssertionError("incremental PMax MA differs from pmax_batch")
+    if len(set(dir[flat_end:].tolist())) < 2:
+        raise AssertionError("PMax dir never changes after a flat stretch")
+
+
+def bench_pmax():
+    check_pmax_batch()
+    pmax_batch(*make_candles(100), 3, 1, 5)  # compile/warm up
+    for n in (1000, 100000, 1000000):
+        high, low, close = make_candles(n)
+        start = time.perf_counter()
+        pmax_batch(high, low, close, 3, 1, 5)
+        elapsed = time.perf_counter() - start
+        print(f"pmax_batch {n:>8} bars: {n / elapsed:,.0f} bars/s")
+
+
+def check_indicators():
+    high, low, close = make_candles(1000)
+    h, l, c = pd.Series(high), pd.Series(low), pd.Series(close)
+    w = 14
+    adx = ADXIndicator(h, l, c, w)
+    # ta reports 0 where a value is not defined yet; compare from there on.
+    pairs = [
+        (
+            ATR(w).seed(high, low, close),
+            AverageTrueRange(h, l, c, w).average_true_range(),
+            w - 1,
+        ),
+        (EMA(w).seed(close), EMAIndicator(c, w).ema_indicator(), w - 1),
+    ]
+    got_adx, got_pos, got_neg = ADX(w).seed(high, low, close)
+    pairs += [
+        (got_adx, adx.adx(), 2 * w - 1),
+        (got_pos, adx.adx_pos(), w + 1),
+        (got_neg, adx.adx_neg(), w + 1),
+    ]
+    for got, want, start in pairs:
+        if not np.allclose(got[start:], want.to_numpy()[start:], rtol=1e-9):
+            raise AssertionError(f"{want.name} differs from ta")
+    print("ATR, EMA and ADX match ta")
+
+
+def bench_indicators(n: int = 100000):
+    """One closed bar through the streaming indicators, against recomputing
+    the 1000-bar series with ta as the task used to."""
+    check_indicators()
+    high, low, close = make_candles(n + 1000)
+    adx = ADX(28)
+    adx.seed(high[:1000], low[:1000], close[:1000])
+    bars = list(zip(high[1000:].tolist(), low[1000:].tolist(), close[1000:].tolist()))
+    start = time.perf_counter()
+    for bar in bars:
+        adx.update(*bar)
+    elapsed = time.perf_counter() - start
+    print(f"ADX.update: {elapsed / n * 1e6:.2f}us/bar")
+    h, l, c = (pd.Series(x[:1000]) for x in (high, low, close))
+    start = time.perf_counter()
+    for _ in range(10):
+        ADXIndicator(h, l, c, 28).adx()
+    elapsed = time.perf_counter() - start
+    print(f"ta ADXIndicator over 1000 bars: {elapsed / 10 * 1e6:.0f}us/recompute")
+
+
+def sign_unkeyed(secretkey: str, param: dict) -> str:
+    """The signing path OKEX used before Signer, for comparison."""
+    headers = {}
+    headers["OK-ACCESS-TIMESTAMP"] = datetime.utcnow().isoformat()[:-3] + "Z"
+    headers["OK-ACCESS-SIGN"] = (
+        headers["OK-ACCESS-TIMESTAMP"]
+        + "POST"
+        + "/api/v5/trade/order"
+        + json.dumps(param)
+    )
+    headers["OK-ACCESS-SIGN"] = base64.b64encode(
+        hmac.new(
+            bytes(secretkey, encoding="utf-8"),
+            bytes(headers["OK-ACCESS-SIGN"], encoding="utf-8"),
+            digestmod="sha256",
+        ).digest()
+    ).decode("utf-8")
+    json.dumps(param)
+    return headers["OK-ACCESS-SIGN"]
+
+
+def bench_sign(n: int = 100000):
+    client = OKEX("key", "DB1A2393D8463D910B856A64DF43199C", "passphrase")
+    param = {
+        "instId": "DOT-USDT-SWAP",
+        "tdMode": "cross",
+        "side": "buy",
+        "ordType": "limit",
+        "sz": "5",
+        "posSide": "long",
+        "px": "17.123",
+    }
+    start = time.perf_counter()
+    for _ in range(n):
+        sign_unkeyed(client.api_secretkey, param)
+    before = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(n):
+        client.prepare_request("POST", "/api/v5/trade/order", param, True)
+    after = n / (time.perf_counter() - start)
+    print(f"sign before: {before:,.0f} requests/s")
+    print(f"sign after:  {after:,.0f} requests/s")
+
+
+def time_log_lines(log: logging.Logger, n: int) -> np.ndarray:
+    order = {"instId": "DOT-USDT-SWAP", "ordId": "312269865356374016", "sCode": "0"}
+    times = np.empty(n)
+    for i in range(n):
+        start = time.perf_counter()
+        log.debug(f"Create order wait filled. {order} {i}")
+        times[i] = time.perf_counter() - start
+        # Let the listener catch up, as the bot's loop would between lines.
+        time.sleep(0.0002)
+    return times
+
+
+def bench_log(n: int = 5000):
+    """Time the calling thread (the event loop in the bot) spends per line."""
+    fmt = logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        before = logging.getLogger("bench.before")
+        before.propagate = False
+        before.setLevel(logging.DEBUG)
+        for handler in (
+            logging.FileHandler(os.path.join(tmp, "before.log")),
+            logging.StreamHandler(devnull),
+        ):
+            handler.setFormatter(fmt)
+            before.addHandler(handler)
+        per_line_before = time_log_lines(before, n)
+
+        after = logging.getLogger("bench.after")
+        after.propagate = False
+        after.setLevel(logging.DEBUG)
+        q = queue.SimpleQueue()
+        handlers = (
+            RotatingFileHandler(os.path.join(tmp, "after.log"), maxBytes=1 << 20),
+            logging.StreamHandler(devnull),
+        )
+        for handler in handlers:
+            handler.setFormatter(fmt)
+        listener = QueueListener(q, *handlers)
+        listener.start()
+        after.addHandler(QueueHandler(q))
+        per_line_after = time_log_lines(after, n)
+        listener.stop()
+        for handler in before.handlers + list(handlers):
+            handler.close()
+    for name, times in (("before", per_line_before), ("after", per_line_after)):
+        p50, p99 = np.percentile(times, [50, 99]) * 1e6
+        print(
+            f"log {name}: blocked per line p50 {p50:.1f} us, "
+            f"p99 {p99:.1f} us, max {times.max() * 1e6:.1f} us"
+        )
+
+
+def bench_precision(n: int = 100000):
+    """Size rounding per call: round_step_size against Precision."""
+    rng = np.random.default_rng(0)
+    sizes = (rng.random(n) * 100).tolist()
+    precision = Precision("0.0001", "0.01", "0.01")
+    for name, fn in (
+        ("round_step_size", lambda sz: round_step_size(sz, 0.01)),
+        ("Precision.size", lambda sz: precision.size(sz, ROUND_DOWN)),
+    ):
+        start = time.perf_counter()
+        for sz in sizes:
+            fn(sz)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>16}: {elapsed / n * 1e6:.2f}us/call")
+    array = np.array(sizes)
+    start = time.perf_counter()
+    precision.sizes(array, ROUND_DOWN)
+    elapsed = time.perf_counter() - start
+    print(f"{'Precision.sizes':>16}: {elapsed / n * 1e9:.1f}ns/value")
+    # Values round_step_size gets wrong or cannot handle.
+    for sz, step in ((0.3, 0.1), (5, 1), (1e-05, 1e-05)):
+        try:
+            old = round_step_size(sz, step)
+        except Exception as e:
+            old = type(e).__name__
+        new = Precision(str(step), str(step), str(step)).size(sz)
+        print(f"{sz!r:>8} step {step!r:<7} round_step_size {old!r:<12} Precision {new}")
+
+
+async def check_feed():
+    """MarketFeed against the mock: candles advance over the business
+    endpoint, and candles subscribed on the public one, which OKX refuses,
+    never count as live."""
+    instId = "SYN0-USDT-SWAP"
+    mock = MockOKX([instId], push_interval=3600)
+    url = await mock.start()
+    ws_url = url.replace("http", "ws")
+    client = OKEX("key", "secret", "passphrase", base_url=url)
+    await client.asyncinit()
+    feed = MarketFeed(client, ws_url + "/ws/v5/business", ws_url + "/ws/v5/public")
+    wrong = MarketFeed(client, ws_url + "/ws/v5/public", ws_url + "/ws/v5/public")
+    try:
+        for f in (feed, wrong):
+            await f.subscribe_candles(instId, "1m")
+            await f.subscribe_ticker(instId)
+            f.start()
+        await asyncio.sleep(0.5)
+        if not feed.live(instId, "1m") or wrong.live(instId, "1m"):
+            raise AssertionError("candles live on the wrong endpoint")
+        store = kline_store(instId, "1m")
+        last = store.last_confirmed_time()
+        mock.advance(60000)
+        await mock.push()
+        await asyncio.sleep(0.2)
+        if store.last_confirmed_time() != last + 60000:
+            raise AssertionError("pushed candles did not reach the store")
+        if feed.ticker(instId) is None:
+            raise AssertionError("no ticker from the public endpoint")
+    finally:
+        await feed.close()
+        await wrong.close()
+        await client.close()
+        await mock.close()
+    print("MarketFeed follows the mock WebSocket")
+
+
+def bench_feed():
+    asyncio.run(check_feed())
+
+
+async def check_telegram():
+    """TelegramHandler against a stub Bot API: lines logged together go out
+    as one message, and a 429 is retried after its retry_after."""
+    received = []
+
+    async def send_message(request: web.Request) -> web.Response:
+        received.append(await request.json())
+        if len(received) == 1:
+            return web.json_response(
+                {"ok": False, "error_code": 429, "parameters": {"retry_after": 1}},
+                status=429,
+            )
+        return web.json_response({"ok": True, "result": {}})
+
+    app = web.Application()
+    app.router.add_post("/bottoken/sendMessage", send_message)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    handler = TelegramHandler(
+        "token", "42", interval=0.2, api_url=f"http://127.0.0.1:{port}/bot{{0}}/{{1}}"
+    )
+    log = logging.getLogger("bench.telegram")
+    log.propagate = False
+    log.addHandler(handler)
+    try:
+        for i in range(5):
+            log.warning(f"line {i}")
+        for _ in range(50):
+            if handler.sent:
+                break
+            await asyncio.sleep(0.1)
+        if handler.sent != 1 or len(received) != 2:
+            raise AssertionError(f"expected a retried send, got {received}")
+        if received[1] != {
+            "chat_id": "42",
+            "text": "".join(f"line {i}\n" for i in range(5)),
+        }:
+            raise AssertionError(f"lines not batched: {received[1]}")
+    finally:
+        log.removeHandler(handler)
+        await asyncio.get_running_loop().run_in_executor(None, handler.close)
+        await runner.cleanup()
+    print("TelegramHandler batches and retries against the stub")
+
+
+def bench_telegram():
+    asyncio.run(check_telegram())
+
+
+BENCHES = {
+    "pmax": bench_pmax,
+    "sign": bench_sign,
+    "log": bench_log,
+    "precision": bench_precision,
+    "indicators": bench_indicators,
+    "feed": bench_feed,
+    "telegram": bench_telegram,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
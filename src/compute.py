@@ -0,0 +1,167 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from kline_store import KlineStore
+from log import logger
+from pmax import PMax
+
+PMAX_COLUMNS = ("Open Time", "PMax", "PMax_MA", "PMax_dir", "hl2")
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+LOOP_LAG_INTERVAL = 0.05
+LOOP_LAG_WARN = 0.5
+
+# Where indicator seeding runs; None runs it on the event loop.
+executor: Executor = None
+
+
+def set_executor(kind: str = None, workers: int = None):
+    """Run indicator seeding on a "thread" or "process" pool, or inline."""
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False)
+    if kind == EXECUTOR_THREAD:
+        executor = ThreadPoolExecutor(workers, thread_name_prefix="indicators")
+    elif kind == EXECUTOR_PROCESS:
+        executor = ProcessPoolExecutor(workers)
+    elif kind is None:
+        executor = None
+    else:
+        raise ValueError(f"Unknown indicator executor {kind}")
+
+
+async def run_in_executor(fn, *args):
+    if executor is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def seed_pmax(
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    atr_length: int,
+    atr_multiplier: float,
+    ma_length: int,
+) -> Tuple[PMax, List[Tuple[Optional[float], float, int, float]]]:
+    state = PMax(atr_length, atr_multiplier, ma_length)
+    return state, state.seed(high, low, close)
+
+
+class PMaxEntry:
+    """PMax state and values of one (instId, bar, atrl, atrm, mal), shared by
+    every task with those settings so each closed bar is computed once."""
+
+    def __init__(self) -> None:
+        self.state: PMax = None
+        self.indicators = KlineStore(PMAX_COLUMNS)
+        self.lock = asyncio.Lock()
+        self.seeds = 0
+        self.hits = 0
+
+    async def update(
+        self, klines: KlineStore, atrl: int, atrm: float, mal: int
+    ) -> KlineStore:
+        """Feed the closed bars not seen yet.
+
+        A cold start, a gap since the last fed bar or a nan MA (a state
+        from before flat windows held the MA) reseeds from the whole
+        history, in the executor; otherwise the new bars are O(1) each and
+        run inline.
+        """
+        async with self.lock:
+            indicators = self.indicators
+            closed = klines.closed_size()
+            ot = klines.view("Open Time")[:closed]
+            if len(ot) == 0:
+                return indicators
+            if indicators.last_time == ot[-1]:
+                self.hits += 1
+                return indicators
+            start = 0
+            if (
+                self.state is not None
+                and len(indicators) != 0
+                and not math.isnan(self.state.ma)
+            ):
+                start = ot.searchsorted(indicators.last_time, side="right")
+            if start == 0 or ot[start - 1] != indicators.last_time:
+                # Copies, since the feed may write the store meanwhile.
+                ot = ot.copy()
+                self.state, values = await run_in_executor(
+                    seed_pmax,
+                    klines.view("High")[:closed].copy(),
+                    klines.view("Low")[:closed].copy(),
+                    klines.view("Close")[:closed].copy(),
+                    atrl,
+                    atrm,
+                    mal,
+                )
+                self.seeds += 1
+                indicators.clear()
+                start = 0
+            else:
+                values = self.state.seed(
+                    klines.view("High")[start:closed],
+                    klines.view("Low")[start:closed],
+                    klines.view("Close")[start:closed],
+                )
+            for t, (pm, ma, dir, src) in zip(ot[start:], values):
+                indicators.append((t, math.nan if pm is None else pm, ma, dir, src))
+            return indicators
+
+
+pmax_entries: Dict[Tuple[str, str, int, float, int], PMaxEntry] = {}
+
+
+def pmax_entry(instId: str, bar: str, atrl: int, atrm: float, mal: int) -> PMaxEntry:
+    """The shared PMax entry for an instrument, bar and parameter set."""
+    key = (instId, bar, atrl, atrm, mal)
+    if key not in pmax_entries:
+        pmax_entries[key] = PMaxEntry()
+    return pmax_entries[key]
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a sleeper that asked for
+    `interval`; the excess is time the loop spent stalled."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL) -> None:
+        self.interval = interval
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.__task: asyncio.Task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def __run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - start - self.interval)
+            self.samples += 1
+            self.total_lag += lag
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > LOOP_LAG_WARN:
+                logger.warning(f"Event loop stalled for {lag:.3f}s")
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "total_lag": self.total_lag,
+            "avg_lag": self.total_lag / self.samples if self.samples else 0.0,
+            "max_lag": self.max_lag,
+        }
+
+
+loop_lag = LoopLagMonitor()
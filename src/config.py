@@ -1,55 +1,247 @@
 import asyncio
+import logging
+import os
 from task import Task
-from typing import List
+from typing import TYPE_CHECKING, List, Tuple
 import yaml
-from okex import OKEX
-from log import logger, set_telegram_log
+import zlib
+from compute import set_executor
+from metrics import METRICS_PORT, start_metrics_server
+from okex import OKEX, RATE_LIMITS, SharedTokenBucket
+from okex_ws import AccountFeed, MarketFeed
+from log import TELEGRAM_API_URL, logger, set_file_log, set_telegram_log
+from snapshot import SNAPSHOT_DIR, SNAPSHOT_INTERVAL, Snapshot, snapshot_path
+
+if TYPE_CHECKING:
+    from scheduler import BarScheduler
+
+CONFIG_FILE = "config.yaml"
+WATCH_INTERVAL = 5.0
+# Sections only read at startup; a reload keeps the running values.
+RESTART_SECTIONS = (
+    "api",
+    "http",
+    "websocket",
+    "resample",
+    "workers",
+    "log",
+    "telegram",
+    "metrics",
+    "indicator_executor",
+    "reload",
+    "reload_interval",
+    "snapshot",
+)
 
 Config = None
 
 
+def load_config(path: str = CONFIG_FILE) -> dict:
+    with open(path, "r") as stream:
+        try:
+            return yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            logger.error(exc)
+
+
+def shard_task_list(task_list: List[dict], count: int) -> List[List[dict]]:
+    """Split task_list into count shards, keeping each instId in one shard so
+    its tasks still share klines and feeds. The shard is a stable hash of
+    the instId, so editing task_list never moves the other instruments to
+    another worker."""
+    shards: List[List[dict]] = [[] for _ in range(count)]
+    for item in task_list:
+        shards[zlib.crc32(item["id"].encode()) % count].append(item)
+    return shards
+
+
 class Config:
-    def __init__(self):
+    def __init__(self, shard: Tuple[int, int] = None, rate_limits: dict = None):
         self.task_list: List[Task] = []
+        self.feed: MarketFeed = None
+        self.account: AccountFeed = None
+        self.client: OKEX = None
+        self.metrics = None
+        self.snapshot: Snapshot = None
+        # (index, count) when this process runs one shard of task_list.
+        self.shard = shard
+        # Shared token bucket states by path, see SharedTokenBucket.
+        self.rate_limits = rate_limits
 
     async def init(self):
         await self.refresh_config()
-
+        snapshot = self.config.get("snapshot", None)
+        if snapshot != None:
+            self.snapshot = Snapshot(
+                snapshot_path(
+                    snapshot.get("path", SNAPSHOT_DIR),
+                    self.shard[0] if self.shard is not None else None,
+                ),
+                snapshot.get("interval", SNAPSHOT_INTERVAL),
+            )
+            self.snapshot.load(self.task_list)
+        set_executor(**self.config.get("indicator_executor", {}))
+        metrics = self.config.get("metrics", None)
+        if metrics != None:
+            port = metrics.get("port", METRICS_PORT)
+            if self.shard is not None:
+                # One endpoint per worker process.
+                port += self.shard[0]
+            self.metrics = await start_metrics_server(
+                metrics.get("host", "127.0.0.1"), port
+            )
         await asyncio.gather(
-            *[asyncio.create_task(task.asyncinit()) for task in self.task_list]
+            *[
+                self.client.metadata.preload(inst_type)
+                for inst_type in {task.inst_type for task in self.task_list}
+            ]
         )
 
-    async def refresh_config(self):
+        await asyncio.gather(
+            *[asyncio.create_task(self.start_task(task)) for task in self.task_list]
+        )
+        if self.feed is not None:
+            self.feed.start()
+        if self.account is not None:
+            self.account.start()
 
-        with open("config.yaml", "r") as stream:
-            try:
-                self.config = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                logger.error(exc)
+    def set_log(self):
+        filelog = self.config.get("log", None)
+        if filelog != None:
+            set_file_log(**filelog)
         telelog = self.config.get("telegram", None)
         if telelog != None:
-            set_telegram_log(telelog["token"], telelog["id"])
+            set_telegram_log(
+                telelog["token"],
+                telelog["id"],
+                telelog.get("level", logging.NOTSET),
+                telelog.get("api_url", TELEGRAM_API_URL),
+            )
+
+    async def refresh_config(self):
+
+        self.config = load_config()
+        if self.shard is None:
+            # Shards log through the supervisor, which sets this up once.
+            self.set_log()
         exchange_config = self.config["api"]
-        client = OKEX(
-            api_key=exchange_config["key"],
-            api_secretkey=exchange_config["secretkey"],
-            api_passphrase=exchange_config["passphrase"],
-            testnet=exchange_config["testnet"],
-        )
-        await client.asyncinit()
-        self.client = client
-        candles_lock = asyncio.Lock()
-        for item in self.config["task_list"]:
-            get_local_or_global_config = lambda s: item.get(s, self.config.get(s))
-            task = Task(
-                client=client,
-                id=item["id"],
-                sz=item["sz"],
-                inst_type=item["inst_type"],
-                atrl=get_local_or_global_config("atrl"),
-                mal=get_local_or_global_config("mal"),
-                atrm=get_local_or_global_config("atrm"),
-                bar=get_local_or_global_config("bar"),
-                candles_lock=candles_lock,
+        if self.client is None:
+            # One client, and so one connection pool, for the whole process.
+            client = OKEX(
+                api_key=exchange_config["key"],
+                api_secretkey=exchange_config["secretkey"],
+                api_passphrase=exchange_config["passphrase"],
+                testnet=exchange_config["testnet"],
+                **self.config.get("http", {}),
             )
-            self.task_list.append(task)
+            if self.rate_limits is not None:
+                client.buckets.update(
+                    {
+                        path: SharedTokenBucket(RATE_LIMITS[path], state)
+                        for path, state in self.rate_limits.items()
+                    }
+                )
+            await client.asyncinit()
+            warm = await client.warmup()
+            logger.debug(f"Warmed up {warm} connections")
+            self.client = client
+        client = self.client
+        if self.config.get("websocket", False) and self.feed is None:
+            self.feed = MarketFeed(client)
+            self.account = AccountFeed(client)
+        for item in self.shard_task_list(self.config):
+            self.task_list.append(self.create_task(item))
+
+    def shard_task_list(self, config: dict) -> List[dict]:
+        task_list = config["task_list"]
+        if self.shard is not None:
+            index, count = self.shard
+            task_list = shard_task_list(task_list, count)[index]
+        return task_list
+
+    def task_settings(self, config: dict, item: dict) -> dict:
+        get_local_or_global_config = lambda s: item.get(s, config.get(s))
+        return {
+            "id": item["id"],
+            "sz": item["sz"],
+            "inst_type": item["inst_type"],
+            "atrl": get_local_or_global_config("atrl"),
+            "mal": get_local_or_global_config("mal"),
+            "atrm": get_local_or_global_config("atrm"),
+            "bar": get_local_or_global_config("bar"),
+        }
+
+    def create_task(self, item: dict) -> Task:
+        return Task(
+            client=self.client,
+            feed=self.feed,
+            account=self.account,
+            resample=self.config.get("resample", False),
+            **self.task_settings(self.config, item),
+        )
+
+    async def start_task(self, task: Task):
+        await task.asyncinit()
+        if self.feed is not None:
+            await self.feed.subscribe_candles(task.id, task.feed_bar)
+            await self.feed.subscribe_ticker(task.id)
+
+    async def reload(self, scheduler: "BarScheduler"):
+        """Apply a changed task_list to the running tasks.
+
+        Tasks are matched by (id, bar). New ones are started and removed ones
+        stopped; the rest get their sz/mal/atrm/atrl updated in place, so
+        their klines and the client's connections stay warm.
+        """
+        config = load_config()
+        if config is None or "task_list" not in config:
+            logger.warning("Config reload skipped, config.yaml is not valid")
+            return
+        for section in RESTART_SECTIONS:
+            if config.get(section) != self.config.get(section):
+                logger.warning(f"Config {section} changed, takes effect on restart")
+        running = {(task.id, task.bar): task for task in self.task_list}
+        wanted = {}
+        for item in self.shard_task_list(config):
+            settings = self.task_settings(config, item)
+            wanted[(settings["id"], settings["bar"])] = (item, settings)
+        self.config = {**config, **{s: self.config.get(s) for s in RESTART_SECTIONS}}
+
+        for key, task in running.items():
+            if key not in wanted:
+                logger.info(f"Config reload: stop {key[0]}/{key[1]}")
+                scheduler.remove(task)
+                if task in self.task_list:
+                    self.task_list.remove(task)
+        for key, (item, settings) in wanted.items():
+            task = running.get(key)
+            if task is None:
+                logger.info(f"Config reload: start {key[0]}/{key[1]}")
+                task = self.create_task(item)
+                try:
+                    await self.start_task(task)
+                except Exception as e:
+                    logger.warning(f"Config reload: {key[0]}/{key[1]} failed {e!r}")
+                    continue
+                if task not in self.task_list:
+                    self.task_list.append(task)
+                scheduler.add(task)
+            elif task.update(
+                settings["mal"], settings["atrm"], settings["atrl"], settings["sz"]
+            ):
+                logger.info(f"Config reload: updated {key[0]}/{key[1]}")
+        scheduler.settle_delay = config.get("settle_delay", scheduler.settle_delay)
+
+    async def watch(self, scheduler: "BarScheduler", interval: float = WATCH_INTERVAL):
+        """Reload whenever config.yaml is modified."""
+        mtime = os.stat(CONFIG_FILE).st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                current = os.stat(CONFIG_FILE).st_mtime
+                if current == mtime:
+                    continue
+                mtime = current
+                await self.reload(scheduler)
+            except Exception as e:
+                logger.warning(f"Config reload failed {e!r}")
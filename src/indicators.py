@@ -0,0 +1,281 @@
+from collections import deque
+import math
+from typing import Iterable, Optional, Tuple
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+
+CMO_LENGTH = 9
+ADX_WINDOW = 14
+
+
+@njit(cache=True)
+def _atr_loop(tr: np.ndarray, window: int) -> np.ndarray:
+    atr = np.full(len(tr), np.nan)
+    if len(tr) < window:
+        return atr
+    seed = 0.0
+    for i in range(window):
+        seed += tr[i]
+    atr[window - 1] = seed / window
+    for i in range(window, len(tr)):
+        atr[i] = (atr[i - 1] * (window - 1) + tr[i]) / float(window)
+    return atr
+
+
+def _window_sum(values: np.ndarray, length: int) -> np.ndarray:
+    # Added newest-first, the same order pmax() uses, so the sums are exact.
+    out = np.zeros(len(values))
+    for i in range(length):
+        out[length - 1 :] += values[length - 1 - i : len(values) - i]
+    return out
+
+
+def true_range(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    prev_close = np.empty(len(close))
+    prev_close[:1] = np.nan
+    prev_close[1:] = close[:-1]
+    return np.fmax(
+        high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close))
+    )
+
+
+def _float_array(values: Iterable[float]) -> np.ndarray:
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+
+class Stateful:
+    """state() gives an indicator's state as plain values for a snapshot,
+    restore() puts it back."""
+
+    def state(self) -> dict:
+        state = {}
+        for name, value in vars(self).items():
+            if isinstance(value, Stateful):
+                value = value.state()
+            elif isinstance(value, (deque, tuple)):
+                value = list(value)
+            state[name] = value
+        return state
+
+    def restore(self, state: dict):
+        for name, value in state.items():
+            current = getattr(self, name)
+            if isinstance(current, Stateful):
+                current.restore(value)
+            elif isinstance(current, deque):
+                setattr(self, name, deque(value, maxlen=current.maxlen))
+            else:
+                setattr(self, name, value)
+
+
+class ATR(Stateful):
+    """Wilder ATR, as ta's AverageTrueRange: the mean true range of the first
+    `window` bars, then smoothed by 1/window each bar.
+
+    update() gives None until `window` bars are in; `value` is 0.0 until
+    then, which is what ta reports.
+    """
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self.count = 0
+        self.prev_close: float = None
+        self.total = 0.0
+        self.value = 0.0
+
+    def update(self, high: float, low: float, close: float) -> Optional[float]:
+        if self.prev_close is None:
+            tr = high - low
+        else:
+            tr = max(
+                high - low, abs(high - self.prev_close), abs(low - self.prev_close)
+            )
+        self.prev_close = close
+        window = self.window
+        self.count += 1
+        if self.count < window:
+            self.total += tr
+            return None
+        if self.count == window:
+            self.value = (self.total + tr) / window
+        else:
+            self.value = (self.value * (window - 1) + tr) / float(window)
+        return self.value
+
+    def seed(
+        self, high: Iterable[float], low: Iterable[float], close: Iterable[float]
+    ) -> np.ndarray:
+        """Feed a run of bars, oldest first; nan where update() gives None."""
+        high, low, close = _float_array(high), _float_array(low), _float_array(close)
+        if self.count != 0 or len(close) < self.window:
+            values = [self.update(*bar) for bar in zip(high, low, close)]
+            return np.array(
+                [math.nan if v is None else v for v in values], dtype=np.float64
+            )
+        atr = _atr_loop(true_range(high, low, close), self.window)
+        self.count = len(close)
+        self.prev_close = float(close[-1])
+        self.value = float(atr[-1])
+        return atr
+
+
+class CMO(Stateful):
+    """Chande momentum oscillator over the last `length` changes of a series,
+    (up - down) / (up + down) in [-1, 1] as pmax() uses it; nan when the
+    series did not move. ta has no CMO, so pmax() is the reference.
+    """
+
+    def __init__(self, length: int = CMO_LENGTH) -> None:
+        self.length = length
+        self.count = 0
+        self.prev: float = None
+        self.up = deque(maxlen=length)
+        self.down = deque(maxlen=length)
+
+    def update(self, value: float) -> Optional[float]:
+        prev = self.prev
+        self.prev = value
+        self.count += 1
+        if prev is None:
+            return None
+        self.up.append(value - prev if value > prev else 0)
+        self.down.append(prev - value if value < prev else 0)
+        if self.count <= self.length:
+            return None
+        # Summed newest first, as pmax() does, so PMax stays exact; a
+        # running sum would drift from it in the last bits.
+        up = sum(reversed(self.up))
+        down = sum(reversed(self.down))
+        return (up - down) / (up + down) if up + down != 0 else math.nan
+
+    def seed(self, values: Iterable[float]) -> np.ndarray:
+        """Feed a run of values, oldest first; nan where update() gives None."""
+        values = _float_array(values)
+        n = len(values)
+        if self.count != 0 or n <= self.length:
+            return np.array(
+                [math.nan if v is None else v for v in map(self.update, values)],
+                dtype=np.float64,
+            )
+        diff = values[1:] - values[:-1]
+        up = np.where(diff > 0, diff, 0.0)
+        down = np.where(diff < 0, -diff, 0.0)
+        up_sum = _window_sum(up, self.length)
+        down_sum = _window_sum(down, self.length)
+        cmo = np.full(n, np.nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cmo[1:] = (up_sum - down_sum) / (up_sum + down_sum)
+        cmo[: self.length] = np.nan
+        self.count = n
+        self.prev = float(values[-1])
+        self.up.extend(up[-self.length :].tolist())
+        self.down.extend(down[-self.length :].tolist())
+        return cmo
+
+
+class EMA(Stateful):
+    """EMA as ta's EMAIndicator: starts at the first value, alpha is
+    2 / (window + 1), and update() gives None for the first window - 1."""
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self.alpha = 2 / (window + 1)
+        self.count = 0
+        self.value: float = None
+
+    def update(self, value: float) -> Optional[float]:
+        if self.value is None:
+            self.value = value
+        else:
+            self.value = self.alpha * value + (1 - self.alpha) * self.value
+        self.count += 1
+        return self.value if self.count >= self.window else None
+
+    def seed(self, values: Iterable[float]) -> np.ndarray:
+        """Feed a run of values, oldest first; nan where update() gives None."""
+        return np.array(
+            [math.nan if v is None else v for v in map(self.update, values)],
+            dtype=np.float64,
+        )
+
+
+class ADX(Stateful):
+    """Wilder +DI, -DI and ADX, as ta's ADXIndicator.
+
+    The true range and directional moves of bars 1..window are summed, then
+    smoothed by 1/window; the DIs are defined from bar `window` on. ADX is
+    the mean DX of the first `window` of those bars, then Wilder smoothed.
+    ta reports 0 for the DIs at bar `window` and before; update() gives
+    None while a value is not defined.
+    """
+
+    def __init__(self, window: int = ADX_WINDOW) -> None:
+        self.window = window
+        self.count = 0
+        self.prev: Tuple[float, float, float] = None
+        self.tr = 0.0
+        self.pos = 0.0
+        self.neg = 0.0
+        self.dx_total = 0.0
+        self.value: float = None
+
+    def update(
+        self, high: float, low: float, close: float
+    ) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+        """Feed one closed bar, return its (ADX, +DI, -DI)."""
+        index = self.count
+        self.count += 1
+        prev = self.prev
+        self.prev = (high, low, close)
+        if prev is None:
+            return None, None, None
+        prev_high, prev_low, prev_close = prev
+        tr = max(high, prev_close) - min(low, prev_close)
+        up = high - prev_high
+        down = prev_low - low
+        pos = up if up > down and up > 0 else 0.0
+        neg = down if down > up and down > 0 else 0.0
+
+        window = self.window
+        if index <= window:
+            self.tr += tr
+            self.pos += pos
+            self.neg += neg
+            if index < window:
+                return None, None, None
+        else:
+            self.tr = self.tr - self.tr / float(window) + tr
+            self.pos = self.pos - self.pos / float(window) + pos
+            self.neg = self.neg - self.neg / float(window) + neg
+
+        di_pos = 100 * (self.pos / self.tr) if self.tr != 0 else 0.0
+        di_neg = 100 * (self.neg / self.tr) if self.tr != 0 else 0.0
+        di_sum = di_pos + di_neg
+        dx = 100 * abs((di_pos - di_neg) / di_sum) if di_sum != 0 else 0.0
+        if index < 2 * window - 1:
+            self.dx_total += dx
+            return None, di_pos, di_neg
+        if index == 2 * window - 1:
+            self.value = (self.dx_total + dx) / window
+        else:
+            self.value = (self.value * (window - 1) + dx) / float(window)
+        return self.value, di_pos, di_neg
+
+    def seed(
+        self, high: Iterable[float], low: Iterable[float], close: Iterable[float]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Feed a run of bars, oldest first; (ADX, +DI, -DI) arrays with nan
+        where update() gives None."""
+        values = [self.update(*bar) for bar in zip(high, low, close)]
+        out = np.array(
+            [[math.nan if v is None else v for v in row] for row in values],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        return out[:, 0], out[:, 1], out[:, 2]
@@ -0,0 +1,125 @@
+import os
+from typing import Dict, Sequence
+import numpy as np
+
+ARCHIVE_DIR = "klines"
+ARCHIVE_MAGIC = b"OKXKLIN1"
+ARCHIVE_HEADER_SIZE = 16
+
+ARCHIVE_COLUMNS = (
+    "Open Time",
+    "Open",
+    "High",
+    "Low",
+    "Close",
+    "Volume",
+    "VolumeCcy",
+    "PMax",
+    "PMax_MA",
+    "PMax_dir",
+    "hl2",
+)
+ARCHIVE_DTYPE = np.dtype(
+    [("Open Time", "<i8")] + [(name, "<f8") for name in ARCHIVE_COLUMNS[1:]]
+)
+
+
+def archive_path(instId: str, bar: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{instId}_{bar}.bin")
+
+
+class KlineArchive:
+    """Append-only file of fixed-width closed-bar records, oldest first.
+
+    A 16-byte header (magic and record size) is followed by ARCHIVE_DTYPE
+    records. Only bars newer than the last record are ever appended, and
+    read() memory-maps the file, so loading a range parses no text.
+
+    A readonly archive never creates or repairs the file: it may be read
+    while the bot appends to it, so a partial last record is just skipped.
+    """
+
+    def __init__(
+        self, path: str, dtype: np.dtype = ARCHIVE_DTYPE, readonly: bool = False
+    ) -> None:
+        self.path = path
+        self.dtype = dtype
+        self.readonly = readonly
+        self.last_time: int = None
+        if not readonly:
+            self.__open()
+
+    def __header(self) -> bytes:
+        return ARCHIVE_MAGIC + self.dtype.itemsize.to_bytes(8, "little")
+
+    def __open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            with open(self.path, "wb") as f:
+                f.write(self.__header())
+            return
+        with open(self.path, "r+b") as f:
+            self.__check(f)
+            size = os.path.getsize(self.path) - ARCHIVE_HEADER_SIZE
+            count = size // self.dtype.itemsize
+            if size % self.dtype.itemsize:
+                # Drop a record cut short by a crash mid-write.
+                f.truncate(ARCHIVE_HEADER_SIZE + count * self.dtype.itemsize)
+            if count:
+                f.seek(ARCHIVE_HEADER_SIZE + (count - 1) * self.dtype.itemsize)
+                last = np.frombuffer(f.read(self.dtype.itemsize), self.dtype)
+                self.last_time = int(last["Open Time"][0])
+
+    def __check(self, f):
+        if f.read(ARCHIVE_HEADER_SIZE) != self.__header():
+            raise ValueError(f"{self.path} is not a kline archive of this format")
+
+    def __len__(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path) - ARCHIVE_HEADER_SIZE
+        return max(size, 0) // self.dtype.itemsize
+
+    def append(self, columns: Dict[str, Sequence[float]]) -> int:
+        """Append rows given as equal-length columns; rows not newer than the
+        last archived bar are skipped. Returns how many were written."""
+        ot = np.asarray(columns["Open Time"], dtype=np.int64)
+        keep = ot > self.last_time if self.last_time is not None else slice(None)
+        records = np.zeros(len(ot), dtype=self.dtype)
+        for name in self.dtype.names:
+            records[name] = columns[name]
+        records = records[keep]
+        if len(records) == 0:
+            return 0
+        with open(self.path, "ab") as f:
+            f.write(records.tobytes())
+        self.last_time = int(records["Open Time"][-1])
+        return len(records)
+
+    def read(self, start: int = None, end: int = None) -> Dict[str, np.ndarray]:
+        """Columns for start <= Open Time < end (ms), as memory-mapped views."""
+        count = len(self)
+        if count == 0:
+            return {name: np.zeros(0, self.dtype[name]) for name in self.dtype.names}
+        if self.readonly:
+            with open(self.path, "rb") as f:
+                self.__check(f)
+        records = np.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode="r",
+            offset=ARCHIVE_HEADER_SIZE,
+            shape=(count,),
+        )
+        ot = records["Open Time"]
+        lo = 0 if start is None else ot.searchsorted(start, side="left")
+        hi = count if end is None else ot.searchsorted(end, side="left")
+        return {name: records[name][lo:hi] for name in self.dtype.names}
+
+
+def read_archive(
+    instId: str, bar: str, start: int = None, end: int = None
+) -> Dict[str, np.ndarray]:
+    return KlineArchive(archive_path(instId, bar), readonly=True).read(start, end)
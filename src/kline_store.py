@@ -0,0 +1,177 @@
+from typing import Dict, Iterable, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from log import logger
+from okex import OKEX
+
+KLINE_COLUMNS = (
+    "Open Time",
+    "Open",
+    "High",
+    "Low",
+    "Close",
+    "Volume",
+    "VolumeCcy",
+    "volCcyQuote",
+    "confirm",
+)
+
+
+class KlineStore:
+    """Fixed-capacity ring buffer of rows keyed by "Open Time", oldest first.
+
+    Every row is written twice, at slot i and i + capacity, so the live
+    window is always one contiguous slice and view() never copies.
+    """
+
+    def __init__(self, columns: Sequence[str] = KLINE_COLUMNS, capacity: int = 1000):
+        self.columns = tuple(columns)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.capacity = capacity
+        self.data = np.zeros((len(self.columns), 2 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def reserve(self, capacity: int):
+        """Grow to hold at least capacity rows, keeping the ones held."""
+        if capacity <= self.capacity:
+            return
+        rows = self.data[:, self.start : self.start + self.size]
+        data = np.zeros((len(self.columns), 2 * capacity))
+        data[:, : self.size] = rows
+        data[:, capacity : capacity + self.size] = rows
+        self.data = data
+        self.capacity = capacity
+        self.start = 0
+
+    def rows(self) -> np.ndarray:
+        """The held rows as a (columns, size) view, oldest first."""
+        return self.data[:, self.start : self.start + self.size]
+
+    def load(self, rows: np.ndarray):
+        """Replace the held rows with rows() of another store."""
+        if rows.shape[0] != len(self.columns):
+            raise ValueError(
+                f"Expected {len(self.columns)} columns, got {rows.shape[0]}"
+            )
+        self.reserve(rows.shape[1])
+        size = rows.shape[1]
+        self.data[:, :size] = rows
+        self.data[:, self.capacity : self.capacity + size] = rows
+        self.start = 0
+        self.size = size
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    @property
+    def last_time(self) -> float:
+        return self.data[0, self.start + self.size - 1] if self.size else None
+
+    def last_confirmed_time(self) -> int:
+        if self.size == 0:
+            return None
+        confirm = self.view("confirm")
+        ot = self.view("Open Time")
+        if confirm[-1]:
+            return (int)(ot[-1])
+        return (int)(ot[-2]) if self.size > 1 else None
+
+    def closed_size(self) -> int:
+        """Number of rows, not counting a trailing in-progress candle."""
+        if self.size == 0:
+            return 0
+        return self.size if self.view("confirm")[-1] else self.size - 1
+
+    def view(self, column: str) -> np.ndarray:
+        return self.data[self.index[column], self.start : self.start + self.size]
+
+    def row(self, i: int) -> Dict[str, float]:
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("KlineStore row out of range")
+        values = self.data[:, self.start + i]
+        return dict(zip(self.columns, values.tolist()))
+
+    def __write(self, slot: int, values: np.ndarray):
+        self.data[:, slot] = values
+        self.data[:, slot + self.capacity] = values
+
+    def append(self, values: Sequence[float]):
+        """Append a row, or overwrite the newest one if it has the same time.
+
+        Rows older than the newest one are ignored.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        last = self.last_time
+        if last is not None and values[0] < last:
+            return
+        if last is not None and values[0] == last:
+            self.__write((self.start + self.size - 1) % self.capacity, values)
+            return
+        if self.size < self.capacity:
+            self.__write((self.start + self.size) % self.capacity, values)
+            self.size += 1
+        else:
+            self.__write(self.start, values)
+            self.start = (self.start + 1) % self.capacity
+
+    def extend(self, rows: Iterable[Sequence[float]]):
+        for row in rows:
+            self.append(row)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.rows().T, columns=self.columns)
+
+
+stores: Dict[Tuple[str, str], KlineStore] = {}
+
+
+def kline_store(instId: str, bar: str) -> KlineStore:
+    """The shared candle store for an (instId, bar) pair."""
+    key = (instId, bar)
+    if key not in stores:
+        stores[key] = KlineStore()
+    return stores[key]
+
+
+async def backfill_klines(
+    client: OKEX, store: KlineStore, instId: str, bar: str
+) -> KlineStore:
+    rows = []
+    after = None
+    for _ in range(store.capacity // 100):
+        candles = await client.candles(instId, bar, after=after, limt=100)
+        if candles["code"] != "0":
+            raise Exception("backfill_klines code not 0. " + str(candles))
+        if len(candles["data"]) == 0:
+            break
+        rows.extend(candles["data"])
+        after = rows[-1][0]
+    store.clear()
+    store.extend([float(v) for v in row] for row in reversed(rows))
+    return store
+
+
+async def fetch_klines(
+    client: OKEX, store: KlineStore, instId: str, bar: str
+) -> KlineStore:
+    """Bring the store up to date, normally with a single request."""
+    last = store.last_confirmed_time()
+    if last == None:
+        return await backfill_klines(client, store, instId, bar)
+    candles = await client.candles(instId, bar, before=str(last), limt=100)
+    if candles["code"] != "0":
+        raise Exception("fetch_klines code not 0. " + str(candles))
+    rows = candles["data"]
+    if len(rows) >= 100:
+        # A full page may not reach back to the cached bars.
+        logger.debug(f"{instId}/{bar} kline gap since {last}, backfilling")
+        return await backfill_klines(client, store, instId, bar)
+    store.extend([float(v) for v in row] for row in reversed(rows))
+    return store
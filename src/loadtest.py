@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import logging
+import time
+from typing import List
+import numpy as np
+from compute import PMaxEntry
+from kline_store import KlineStore
+from log import logger
+from mock_okx import BAR_MS, MockOKX
+from okex import INST_TYPE_SWAP, OKEX
+from task import Task
+
+
+class TimedOKEX(OKEX):
+    """OKEX that records the round-trip time of every order it places."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.order_times: List[float] = []
+
+    async def order_coalesced(self, *args, **kwargs) -> dict:
+        start = time.perf_counter()
+        try:
+            return await super().order_coalesced(*args, **kwargs)
+        finally:
+            self.order_times.append(time.perf_counter() - start)
+
+
+async def run_load(mock: MockOKX, url: str, n: int, bar: str, cycles: int) -> dict:
+    """Run n synthetic instruments for `cycles` bars against the mock."""
+    mock.instruments = [f"SYN{i}-USDT-SWAP" for i in range(n)]
+    client = TimedOKEX("key", "secret", "passphrase", base_url=url)
+    await client.asyncinit()
+    tasks = []
+    for instId in mock.instruments:
+        task = Task(client, INST_TYPE_SWAP, instId, bar, 5, 1, 3, "1", archive=False)
+        task.klines = KlineStore()
+        task.pmax = PMaxEntry()
+        tasks.append(task)
+    await client.metadata.preload(INST_TYPE_SWAP)
+    await asyncio.gather(*[task.asyncinit() for task in tasks])
+    # The first cycle backfills every store; only steady state is measured.
+    await asyncio.gather(*[task.run() for task in tasks])
+
+    walls = []
+    requests = []
+    rate_limited = mock.stats()["rate_limited"]
+    client.order_times.clear()
+    for _ in range(cycles):
+        mock.advance(BAR_MS[bar])
+        before = mock.stats()["requests"]
+        start = time.perf_counter()
+        await asyncio.gather(*[task.run() for task in tasks])
+        walls.append(time.perf_counter() - start)
+        requests.append(mock.stats()["requests"] - before)
+    await client.close()
+
+    orders = np.array(client.order_times)
+    p50, p99 = np.percentile(orders, [50, 99]) if len(orders) else (0.0, 0.0)
+    return {
+        "instruments": n,
+        "cycle_p50": float(np.median(walls)),
+        "cycle_max": max(walls),
+        "requests_per_cycle": sum(requests) / cycles,
+        "rate_limited": mock.stats()["rate_limited"] - rate_limited,
+        "orders": len(orders),
+        "order_p50": p50,
+        "order_p99": p99,
+    }
+
+
+async def main(args):
+    logger.setLevel(logging.INFO)
+    mock = MockOKX(
+        [],
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        fill_delay=args.fill_delay,
+        fill_ratio=args.fill_ratio,
+        period=args.period,
+    )
+    url = await mock.start()
+    budget = args.budget if args.budget is not None else BAR_MS[args.bar] / 1000
+    n = args.start
+    try:
+        while n <= args.max:
+            r = await run_load(mock, url, n, args.bar, args.cycles)
+            print(
+                f"{r['instruments']:>5} instruments: "
+                f"cycle p50 {r['cycle_p50']:.3f}s max {r['cycle_max']:.3f}s, "
+                f"{r['requests_per_cycle']:.0f} requests/cycle, "
+                f"{r['rate_limited']} rate limited, "
+                f"{r['orders']} orders p50 {r['order_p50'] * 1000:.1f}ms "
+                f"p99 {r['order_p99'] * 1000:.1f}ms"
+            )
+            if r["cycle_max"] > budget:
+                print(f"Falls behind the {budget:g}s bar at {n} instruments")
+                break
+            n *= 2
+    finally:
+        await mock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Grow the number of instruments until a cycle outlasts the bar"
+    )
+    parser.add_argument("--bar", default="1m")
+    parser.add_argument("--budget", type=float, default=None)
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--max", type=int, default=4096)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--rate-limit", action="store_true")
+    parser.add_argument("--fill-delay", type=float, default=0.2)
+    parser.add_argument("--fill-ratio", type=float, default=1.0)
+    # Bars per swing of the synthetic price; shorter means more trades.
+    parser.add_argument("--period", type=float, default=12.0)
+    asyncio.run(main(parser.parse_args()))
@@ -1,36 +1,252 @@
+import atexit
+import json
 import logging
-import telebot
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import threading
+import time
+from typing import List
+import requests
+
+LOG_FILE = "logger.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Fields tasks attach to their records, see Task.logger.
+LOG_CONTEXT_FIELDS = ("task", "instId", "bar")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the task context fields when present."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        d = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            if hasattr(record, field):
+                d[field] = getattr(record, field)
+        if record.exc_info:
+            d["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(d, default=str)
 
 
 rootLogger = logging.getLogger()
 
 formatter = logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
-fileHandler = logging.FileHandler("logger.log")
+fileHandler = RotatingFileHandler(
+    LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+)
 fileHandler.setFormatter(formatter)
-rootLogger.addHandler(fileHandler)
 
 streamHandler = logging.StreamHandler()
 streamHandler.setFormatter(formatter)
-rootLogger.addHandler(streamHandler)
+
+# File and console writes happen on the listener thread, never on the
+# event loop; loggers only pay for putting the record on the queue.
+logQueue = queue.SimpleQueue()
+rootLogger.addHandler(QueueHandler(logQueue))
+listener = QueueListener(
+    logQueue, fileHandler, streamHandler, respect_handler_level=True
+)
+listener.start()
+
+
+def stop_log():
+    listener.stop()
+
+
+atexit.register(stop_log)
 
 logger = logging.getLogger("okex_bot")
 logger.setLevel(level=logging.DEBUG)
 
 
+def set_file_log(
+    filename: str = LOG_FILE,
+    max_bytes: int = LOG_MAX_BYTES,
+    backup_count: int = LOG_BACKUP_COUNT,
+    json_lines: bool = False,
+):
+    global fileHandler, listener
+    handler = RotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backup_count
+    )
+    handler.setFormatter(JsonFormatter() if json_lines else formatter)
+    listener.stop()
+    fileHandler.close()
+    fileHandler = handler
+    listener = QueueListener(
+        logQueue, fileHandler, streamHandler, respect_handler_level=True
+    )
+    listener.start()
+
+
+class ForwardHandler(logging.Handler):
+    """Hands records from other processes to the logger they were sent to."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def share_log(log_queue) -> None:
+    """Send this process's records to log_queue instead of its own handlers;
+    the parent process writes them through forward_log()."""
+    atexit.unregister(stop_log)
+    listener.stop()
+    fileHandler.close()
+    for handler in rootLogger.handlers[:]:
+        rootLogger.removeHandler(handler)
+    rootLogger.addHandler(QueueHandler(log_queue))
+
+
+def forward_log(log_queue) -> QueueListener:
+    """Log records queued by share_log() in other processes here."""
+    shared = QueueListener(log_queue, ForwardHandler())
+    shared.start()
+    atexit.register(shared.stop)
+    return shared
+
+
+TELEGRAM_API_URL = "https://api.telegram.org/bot{0}/{1}"
+TELEGRAM_TIMEOUT = 10
+TELEGRAM_MESSAGE_MAX = 4096
+TELEGRAM_INTERVAL = 3.0
+TELEGRAM_SEND_SPACING = 1.0
+TELEGRAM_MAX_CHUNKS = 3
+TELEGRAM_QUEUE_SIZE = 1000
+
+
 class TelegramHandler(logging.Handler):
-    def __init__(self, token: str, id: str, level=logging.NOTSET) -> None:
-        self.bot = telebot.TeleBot(token=token)
+    """Sends log records to a Telegram chat from a background thread.
+
+    emit() only formats the record and queues it, so the event loop never
+    waits on Telegram. The worker joins everything queued within
+    `interval` seconds into one message, keeps sends at least
+    TELEGRAM_SEND_SPACING apart, and reports what it had to drop when the
+    queue or a batch overflows. Messages go to `api_url` through the
+    handler's own session, so a stub server can stand in for Telegram.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        id: str,
+        level=logging.NOTSET,
+        interval: float = TELEGRAM_INTERVAL,
+        queue_size: int = TELEGRAM_QUEUE_SIZE,
+        api_url: str = TELEGRAM_API_URL,
+    ) -> None:
+        self.url = api_url.format(token, "sendMessage")
+        self.session = requests.Session()
         self.id = id
+        self.interval = interval
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.sent = 0
+        self.last_send = 0.0
         super(TelegramHandler, self).__init__(level=level)
+        # urllib3 logs our own requests; sending those would loop forever.
+        self.addFilter(lambda record: not record.name.startswith("urllib3"))
+        self.worker = threading.Thread(
+            target=self.__work, name="TelegramHandler", daemon=True
+        )
+        self.worker.start()
 
     def emit(self, record: logging.LogRecord) -> None:
         try:
-            self.bot.send_message(self.id, self.format(record=record))
+            self.queue.put_nowait(self.format(record=record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self) -> None:
+        try:
+            self.queue.put(None, timeout=1)
+            self.worker.join(timeout=self.interval + 5)
+        except queue.Full:
+            pass
+        self.session.close()
+        super(TelegramHandler, self).close()
+
+    def __work(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                return
+            lines = [line]
+            deadline = time.monotonic() + self.interval
+            stop = False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    line = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if line is None:
+                    stop = True
+                    break
+                lines.append(line)
+            self.__send_batch(lines)
+            if stop:
+                return
+
+    def __send_batch(self, lines: List[str]):
+        chunks = []
+        chunk = ""
+        for i, line in enumerate(lines):
+            line = line[: TELEGRAM_MESSAGE_MAX - 1]
+            if len(chunk) + len(line) + 1 > TELEGRAM_MESSAGE_MAX:
+                if len(chunks) + 1 == TELEGRAM_MAX_CHUNKS:
+                    self.dropped += len(lines) - i
+                    break
+                chunks.append(chunk)
+                chunk = ""
+            chunk += line + "\n"
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            note = f"... {dropped} log lines dropped"
+            if len(chunk) + len(note) > TELEGRAM_MESSAGE_MAX:
+                chunks.append(chunk)
+                chunk = ""
+            chunk += note
+        chunks.append(chunk)
+        for chunk in chunks:
+            self.__send(chunk)
+
+    def __send(self, text: str):
+        wait = self.last_send + TELEGRAM_SEND_SPACING - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            r = self.session.post(
+                self.url,
+                json={"chat_id": self.id, "text": text},
+                timeout=TELEGRAM_TIMEOUT,
+            )
+            d = r.json()
+            if d.get("ok"):
+                self.sent += 1
+                return
+            retry_after = d.get("parameters", {}).get("retry_after")
+            if d.get("error_code") == 429 and retry_after:
+                time.sleep(retry_after)
+                return self.__send(text)
+            print(str(d))
         except Exception as e:
             print(str(e))
+        finally:
+            self.last_send = time.monotonic()
 
 
-def set_telegram_log(token: str, id: str):
-    telelog = TelegramHandler(token, id)
+def set_telegram_log(
+    token: str, id: str, level=logging.NOTSET, api_url: str = TELEGRAM_API_URL
+):
+    telelog = TelegramHandler(token, id, level=level, api_url=api_url)
     telelog.setFormatter(formatter)
     rootLogger.addHandler(telelog)
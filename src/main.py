@@ -1,5 +1,8 @@
 import asyncio
-from config import Config
+import signal
+from typing import Tuple
+from config import WATCH_INTERVAL, Config, load_config
+from log import logger
 from okex import OKEX
 import pandas as pd
 from ta.trend import ADXIndicator
@@ -7,18 +10,56 @@ from ta.trend import ADXIndicator
 from pandas.core.frame import DataFrame
 
 from pmax import pmax
+from scheduler import DEFAULT_SETTLE_DELAY, BarScheduler
 
 
-async def main():
-    config = Config()
+async def main(shard: Tuple[int, int] = None, rate_limits: dict = None):
+    config = Config(shard, rate_limits)
     await config.init()
-    while True:
-        await asyncio.gather(
-            *[asyncio.create_task(task.run()) for task in config.task_list]
+    scheduler = BarScheduler(
+        config.task_list,
+        feed=config.feed,
+        settle_delay=config.config.get("settle_delay", DEFAULT_SETTLE_DELAY),
+    )
+    watcher = snapshotter = None
+    if config.config.get("reload", True):
+        watcher = asyncio.create_task(
+            config.watch(
+                scheduler, config.config.get("reload_interval", WATCH_INTERVAL)
+            )
         )
-        await asyncio.sleep(30)
+    if config.snapshot is not None:
+        snapshotter = asyncio.create_task(config.snapshot.run(config.task_list))
+    # Ctrl-C, or terminate() from the supervisor, stops the loop through
+    # cancellation, so the snapshot task still writes its final save. Only
+    # the first signal cancels; a second must not cut that save short.
+    running = asyncio.current_task()
+    stopping = asyncio.Event()
+
+    def stop():
+        if not stopping.is_set():
+            stopping.set()
+            running.cancel()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+    try:
+        await scheduler.run()
+    except asyncio.CancelledError:
+        logger.info("Stopping")
+    finally:
+        for task in (watcher, snapshotter):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    workers = load_config().get("workers", 1)
+    if workers > 1:
+        from supervisor import Supervisor
+
+        Supervisor(workers).run()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,167 @@
+from bisect import bisect_left
+import functools
+import time
+from typing import Dict, List, Sequence, Tuple
+from aiohttp import web
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        registry.append(self)
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Span:
+    """Times a `with` block into a histogram; works around awaits too."""
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple[str, ...]) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Histogram:
+    """Latency histogram. Only the matching bucket is counted on observe();
+    the cumulative counts Prometheus expects are summed when rendering."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count, sum]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+        registry.append(self)
+
+    def observe(self, value: float, *labels: str):
+        v = self.values.get(labels)
+        if v is None:
+            v = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        v[bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+
+    def time(self, *labels: str) -> Span:
+        return Span(self, labels)
+
+    def timed(self, *labels: str):
+        """Decorator timing every call of a coroutine function."""
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with Span(self, labels):
+                    return await fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, v in self.values.items():
+            count = 0
+            for le, n in zip(self.buckets + ("+Inf",), v):
+                count += n
+                le = _labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            name = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{name} {v[-1]}")
+            lines.append(f"{self.name}_count{name} {count}")
+        return lines
+
+
+registry: List[object] = []
+
+API_REQUESTS = Counter(
+    "okex_api_requests_total", "REST requests sent, by endpoint.", ("endpoint",)
+)
+API_ERRORS = Counter(
+    "okex_api_errors_total",
+    "REST requests that raised or returned a non-zero code, by endpoint.",
+    ("endpoint",),
+)
+API_RATE_LIMITED = Counter(
+    "okex_api_rate_limited_total",
+    "REST requests answered with 429 or code 50011, by endpoint.",
+    ("endpoint",),
+)
+API_LATENCY = Histogram(
+    "okex_api_request_seconds", "REST request round-trip time.", ("endpoint",)
+)
+TASK_STAGE = Histogram(
+    "okex_bot_task_stage_seconds", "Time spent in each stage of a task run.", ("stage",)
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _serve_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(
+    host: str = METRICS_HOST, port: int = METRICS_PORT
+) -> web.AppRunner:
+    """Serve render() at http://host:port/metrics for Prometheus to scrape."""
+    app = web.Application()
+    app.add_routes([web.get("/metrics", _serve_metrics)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
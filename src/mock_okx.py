@@ -0,0 +1,429 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from typing import Dict, List, Set, Tuple
+from aiohttp import WSMsgType, web
+from okex import RATE_LIMIT_CODE, RATE_LIMIT_PERIOD, RATE_LIMITS, SIDE_BUY
+
+BAR_MS = {
+    "1m": 60000,
+    "3m": 180000,
+    "5m": 300000,
+    "15m": 900000,
+    "30m": 1800000,
+    "1H": 3600000,
+    "2H": 7200000,
+    "4H": 14400000,
+    "1Dutc": 86400000,
+}
+MOCK_TICK_SIZE = "0.001"
+MOCK_LOT_SIZE = "1"
+MOCK_MIN_SIZE = "1"
+MOCK_CT_VAL = "1"
+MOCK_LEVER = "10"
+MOCK_CANDLES_MAX = 300
+MOCK_PUSH_INTERVAL = 1.0
+
+
+class MockOKX:
+    """Local stand-in for the OKX v5 REST endpoints OKEX uses.
+
+    Candles of every instrument are a deterministic function of their open
+    time, so any page can be served without storing history. The clock
+    starts at real time and can be moved forward with advance(), letting a
+    harness close bars on demand. Every response waits `latency` (plus up
+    to `jitter`) seconds; with `rate_limit` set, endpoints over their OKX
+    limit answer with a 429 or code 50011 as the exchange would. Orders
+    fill `fill_delay` seconds after placement with probability
+    `fill_ratio`, otherwise they stay live until canceled.
+
+    /ws/v5/public serves the tickers channel and /ws/v5/business the candle
+    channels; subscribing to a channel on the wrong one gets the error
+    event OKX sends. Every `push_interval` seconds, or on push(), each
+    subscription gets its latest data.
+    """
+
+    def __init__(
+        self,
+        instruments: List[str],
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit: bool = False,
+        rate_limit_status: int = 429,
+        fill_delay: float = 0.0,
+        fill_ratio: float = 1.0,
+        period: float = 40.0,
+        seed: int = 0,
+        push_interval: float = MOCK_PUSH_INTERVAL,
+    ) -> None:
+        self.instruments = list(instruments)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.rate_limit_status = rate_limit_status
+        self.fill_delay = fill_delay
+        self.fill_ratio = fill_ratio
+        self.period = period
+        self.random = random.Random(seed)
+        self.offset = 0
+        self.orders: Dict[str, dict] = {}
+        self.next_ordId = 1
+        self.positions: Dict[tuple, dict] = {}
+        self.leverage: Dict[str, str] = {}
+        self.windows: Dict[str, List[float]] = {}
+        self.requests: Dict[str, int] = {}
+        self.rate_limited = 0
+        self.push_interval = push_interval
+        # Open WebSockets and their (channel, instId) subscriptions.
+        self.sockets: Dict[web.WebSocketResponse, Set[Tuple[str, str]]] = {}
+        self.pusher: asyncio.Task = None
+        self.app = web.Application(middlewares=[self.__middleware])
+        self.app.add_routes(
+            [
+                web.get("/api/v5/public/time", self.__time),
+                web.get("/api/v5/public/instruments", self.__instruments),
+                web.get("/api/v5/market/candles", self.__candles),
+                web.get("/api/v5/market/ticker", self.__ticker),
+                web.get("/api/v5/account/positions", self.__positions),
+                web.get("/api/v5/account/leverage-info", self.__leverage_info),
+                web.post("/api/v5/account/set-leverage", self.__set_leverage),
+                web.post("/api/v5/trade/order", self.__order),
+                web.get("/api/v5/trade/order", self.__get_order),
+                web.post("/api/v5/trade/batch-orders", self.__batch_orders),
+                web.post("/api/v5/trade/cancel-order", self.__cancel_order),
+                web.post("/api/v5/trade/cancel-batch-orders", self.__cancel_batch),
+                web.get("/ws/v5/public", self.__ws_public),
+                web.get("/ws/v5/business", self.__ws_business),
+            ]
+        )
+        self.runner: web.AppRunner = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve on host:port (0 picks a free port), return the base URL."""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.pusher = asyncio.create_task(self.__push_loop())
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self.pusher is not None:
+            self.pusher.cancel()
+            self.pusher = None
+        for ws in list(self.sockets):
+            await ws.close()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def now(self) -> int:
+        return int(time.time() * 1000) + self.offset
+
+    def advance(self, ms: int):
+        self.offset += ms
+
+    def stats(self) -> dict:
+        return {
+            "requests": sum(self.requests.values()),
+            "rate_limited": self.rate_limited,
+            "by_endpoint": dict(self.requests),
+        }
+
+    def candle(self, instId: str, bar_ms: int, ot: int) -> list:
+        """The candle of instId opening at ot; a sine wave with noise, so
+        PMax changes direction every few dozen bars."""
+        phase = (sum(map(ord, instId)) % 97) / 97 * 2 * math.pi
+        i = ot // bar_ms
+
+        def price(t: float) -> float:
+            return 100 + 5 * math.sin(t * 2 * math.pi / self.period + phase)
+
+        noise = random.Random(f"{instId}/{bar_ms}/{i}")
+        o = price(i)
+        c = price(i + 1)
+        h = max(o, c) + noise.random() * 0.3
+        l = min(o, c) - noise.random() * 0.3
+        v = noise.random() * 1000
+        return [ot, o, h, l, c, v, v * c, v * c]
+
+    def candle_row(self, instId: str, bar_ms: int, ot: int) -> List[str]:
+        """The candle as OKX sends it, with confirm "0" while it is open."""
+        row = self.candle(instId, bar_ms, ot)
+        current = self.now() // bar_ms * bar_ms
+        return [str(v) for v in row] + ["0" if ot == current else "1"]
+
+    def ticker(self, instId: str) -> dict:
+        now = self.now()
+        _, _, _, _, last, *_ = self.candle(instId, 60000, now // 60000 * 60000)
+        tick = float(MOCK_TICK_SIZE)
+        return {
+            "instId": instId,
+            "last": str(round(last, 3)),
+            "bidPx": str(round(last - tick, 3)),
+            "askPx": str(round(last + tick, 3)),
+            "ts": str(now),
+        }
+
+    async def push(self):
+        """Send every subscription its latest data: the last closed and the
+        open candle, or the ticker."""
+        for ws, subscriptions in list(self.sockets.items()):
+            for channel, instId in list(subscriptions):
+                arg = {"channel": channel, "instId": instId}
+                if channel == "tickers":
+                    messages = [[self.ticker(instId)]]
+                else:
+                    bar_ms = BAR_MS[channel[len("candle") :]]
+                    current = self.now() // bar_ms * bar_ms
+                    messages = [
+                        [self.candle_row(instId, bar_ms, ot)]
+                        for ot in (current - bar_ms, current)
+                    ]
+                for data in messages:
+                    try:
+                        await ws.send_str(json.dumps({"arg": arg, "data": data}))
+                    except ConnectionError:
+                        break
+
+    async def __push_loop(self):
+        while True:
+            await asyncio.sleep(self.push_interval)
+            await self.push()
+
+    async def __websocket(self, request: web.Request, accepts) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscriptions: Set[Tuple[str, str]] = set()
+        self.sockets[ws] = subscriptions
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                if msg.data == "ping":
+                    await ws.send_str("pong")
+                    continue
+                d = json.loads(msg.data)
+                if d.get("op") != "subscribe":
+                    continue
+                for arg in d.get("args", []):
+                    channel, instId = arg["channel"], arg["instId"]
+                    if not accepts(channel):
+                        await ws.send_json(
+                            {
+                                "event": "error",
+                                "code": "60018",
+                                "msg": f"Wrong URL or channel:{channel},instId:{instId} doesn't exist.",
+                            }
+                        )
+                        continue
+                    subscriptions.add((channel, instId))
+                    await ws.send_json({"event": "subscribe", "arg": arg})
+        finally:
+            self.sockets.pop(ws, None)
+        return ws
+
+    async def __ws_public(self, request: web.Request):
+        return await self.__websocket(request, lambda channel: channel == "tickers")
+
+    async def __ws_business(self, request: web.Request):
+        return await self.__websocket(
+            request, lambda channel: channel.startswith("candle")
+        )
+
+    def __ok(self, data: list) -> web.Response:
+        return web.json_response({"code": "0", "msg": "", "data": data})
+
+    @web.middleware
+    async def __middleware(self, request: web.Request, handler):
+        path = request.path
+        self.requests[path] = self.requests.get(path, 0) + 1
+        delay = self.latency + self.random.random() * self.jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rate_limit and path in RATE_LIMITS:
+            now = time.monotonic()
+            window = [
+                t for t in self.windows.get(path, []) if t > now - RATE_LIMIT_PERIOD
+            ]
+            if len(window) >= RATE_LIMITS[path]:
+                self.windows[path] = window
+                self.rate_limited += 1
+                if self.rate_limit_status == 429:
+                    return web.Response(status=429)
+                return web.json_response(
+                    {"code": RATE_LIMIT_CODE, "msg": "Too Many Requests", "data": []}
+                )
+            window.append(now)
+            self.windows[path] = window
+        return await handler(request)
+
+    async def __time(self, request: web.Request):
+        return self.__ok([{"ts": str(self.now())}])
+
+    async def __instruments(self, request: web.Request):
+        instType = request.query.get("instType")
+        return self.__ok(
+            [
+                {
+                    "instId": instId,
+                    "instType": instType,
+                    "tickSz": MOCK_TICK_SIZE,
+                    "lotSz": MOCK_LOT_SIZE,
+                    "minSz": MOCK_MIN_SIZE,
+                    "ctVal": MOCK_CT_VAL,
+                    "lever": MOCK_LEVER,
+                }
+                for instId in self.instruments
+            ]
+        )
+
+    async def __candles(self, request: web.Request):
+        q = request.query
+        instId = q["instId"]
+        bar_ms = BAR_MS[q.get("bar", "1m")]
+        limit = min(int(q.get("limit", 100)), MOCK_CANDLES_MAX)
+        current = self.now() // bar_ms * bar_ms
+        newest = current
+        if "after" in q:
+            newest = min(newest, (int(q["after"]) - 1) // bar_ms * bar_ms)
+        oldest = newest - (limit - 1) * bar_ms
+        if "before" in q:
+            oldest = max(oldest, (int(q["before"]) // bar_ms + 1) * bar_ms)
+        data = [
+            self.candle_row(instId, bar_ms, ot)
+            for ot in range(newest, oldest - 1, -bar_ms)
+        ]
+        return self.__ok(data)
+
+    async def __ticker(self, request: web.Request):
+        return self.__ok([self.ticker(request.query["instId"])])
+
+    async def __positions(self, request: web.Request):
+        instId = request.query.get("instId")
+        return self.__ok(
+            [
+                p
+                for (id, _), p in self.positions.items()
+                if instId is None or id == instId
+            ]
+        )
+
+    async def __leverage_info(self, request: web.Request):
+        instId = request.query["instId"]
+        return self.__ok(
+            [
+                {
+                    "instId": instId,
+                    "mgnMode": request.query.get("mgnMode"),
+                    "lever": self.leverage.get(instId, MOCK_LEVER),
+                }
+            ]
+        )
+
+    async def __set_leverage(self, request: web.Request):
+        d = await request.json()
+        self.leverage[d["instId"]] = d["lever"]
+        return self.__ok([{"instId": d["instId"], "lever": d["lever"]}])
+
+    def __fill(self, order: dict):
+        if order["state"] != "live":
+            return
+        order["state"] = "filled"
+        key = (order["instId"], order["posSide"])
+        sz = float(order["sz"])
+        opening = (order["side"] == SIDE_BUY) == (order["posSide"] == "long")
+        position = self.positions.get(key)
+        pos = float(position["pos"]) if position is not None else 0.0
+        pos = pos + sz if opening else max(0.0, pos - sz)
+        if pos == 0:
+            self.positions.pop(key, None)
+            return
+        px = order["px"] or "0"
+        self.positions[key] = {
+            "instId": order["instId"],
+            "posSide": order["posSide"],
+            "pos": f"{pos:g}",
+            "availPos": f"{pos:g}",
+            "avgPx": position["avgPx"] if position is not None and opening else px,
+        }
+
+    def __place(self, d: dict) -> dict:
+        ordId = str(self.next_ordId)
+        self.next_ordId += 1
+        order = {
+            "ordId": ordId,
+            "instId": d["instId"],
+            "side": d["side"],
+            "posSide": d.get("posSide", "net"),
+            "sz": str(d["sz"]),
+            "px": d.get("px"),
+            "state": "live",
+        }
+        self.orders[ordId] = order
+        if self.random.random() < self.fill_ratio:
+            if self.fill_delay > 0:
+                asyncio.get_running_loop().call_later(
+                    self.fill_delay, self.__fill, order
+                )
+            else:
+                self.__fill(order)
+        return {"ordId": ordId, "clOrdId": "", "sCode": "0", "sMsg": ""}
+
+    def __cancel(self, d: dict) -> dict:
+        order = self.orders.get(d.get("ordId"))
+        if order is None or order["state"] != "live":
+            return {"ordId": d.get("ordId"), "sCode": "51400", "sMsg": "Cancel failed"}
+        order["state"] = "canceled"
+        return {"ordId": order["ordId"], "sCode": "0", "sMsg": ""}
+
+    async def __order(self, request: web.Request):
+        return self.__ok([self.__place(await request.json())])
+
+    async def __batch_orders(self, request: web.Request):
+        return self.__ok([self.__place(d) for d in await request.json()])
+
+    async def __get_order(self, request: web.Request):
+        order = self.orders.get(request.query.get("ordId"))
+        if order is None:
+            return web.json_response(
+                {"code": "51603", "msg": "Order does not exist", "data": []}
+            )
+        return self.__ok([order])
+
+    async def __cancel_order(self, request: web.Request):
+        return self.__ok([self.__cancel(await request.json())])
+
+    async def __cancel_batch(self, request: web.Request):
+        return self.__ok([self.__cancel(d) for d in await request.json()])
+
+
+async def serve(args):
+    mock = MockOKX(
+        [f"SYN{i}-USDT-SWAP" for i in range(args.instruments)],
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        fill_delay=args.fill_delay,
+        fill_ratio=args.fill_ratio,
+    )
+    url = await mock.start(args.host, args.port)
+    print(f"Mock OKX listening on {url}")
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OKX REST stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--instruments", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", action="store_true")
+    parser.add_argument("--fill-delay", type=float, default=0.0)
+    parser.add_argument("--fill-ratio", type=float, default=1.0)
+    asyncio.run(serve(parser.parse_args()))
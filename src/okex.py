@@ -1,12 +1,30 @@
+import asyncio
 from enum import Enum
 import json
 from os import fork
-from urllib.parse import urljoin, urlencode
+from urllib.parse import urlencode
+import hashlib
 import hmac
+import time
+from typing import Callable, Dict, List, Set, Tuple, Union
 import aiohttp
-from datetime import datetime
+from datetime import datetime, timezone
+from yarl import URL
 
 import base64
+from metrics import API_ERRORS, API_LATENCY, API_RATE_LIMITED, API_REQUESTS
+
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
 
 # from log import logger
 
@@ -16,6 +34,20 @@ class ClientError(Exception):
         super().__init__(*args)
 
 
+class Signer:
+    """HMAC-SHA256 signer keyed once; each signature copies the keyed state."""
+
+    def __init__(self, secretkey: str) -> None:
+        self.hmac = hmac.new(
+            bytes(secretkey or "", encoding="utf-8"), digestmod=hashlib.sha256
+        )
+
+    def sign(self, prehash: bytes) -> str:
+        h = self.hmac.copy()
+        h.update(prehash)
+        return base64.b64encode(h.digest()).decode("ascii")
+
+
 ORDER_TD_MODE_ISOLATED = "isolated"
 ORDER_TD_MODE_CROSS = "cross"
 ORDER_TD_MODECASH = "cash"
@@ -45,6 +77,230 @@ INST_TYPE_SWAP = "SWAP"
 INST_TYPE_FUTURES = "FUTURES"
 INST_TYPE_OPTION = "OPTION"
 
+# Requests per 2 seconds, from the OKX v5 rate limit docs.
+RATE_LIMIT_PERIOD = 2.0
+RATE_LIMITS = {
+    "/api/v5/market/candles": 40,
+    "/api/v5/market/ticker": 20,
+    "/api/v5/public/instruments": 20,
+    "/api/v5/trade/order": 60,
+    "/api/v5/trade/cancel-order": 60,
+    "/api/v5/trade/batch-orders": 60,
+    "/api/v5/trade/cancel-batch-orders": 60,
+    "/api/v5/trade/orders-history": 40,
+    "/api/v5/account/positions": 10,
+    "/api/v5/account/leverage-info": 20,
+    "/api/v5/account/set-leverage": 20,
+}
+DEFAULT_RATE_LIMIT = 10
+
+RATE_LIMIT_CODE = "50011"
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 0.5
+
+
+class TokenBucket:
+    """Async token bucket. Callers reserve a token up front, so waiters are
+    served in arrival order and run concurrently up to the limit."""
+
+    def __init__(self, limit: int, period: float = RATE_LIMIT_PERIOD) -> None:
+        self.capacity = float(limit)
+        self.rate = limit / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self) -> float:
+        """Take a token, return how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self) -> float:
+        wait = self.reserve()
+        if wait == 0:
+            return 0.0
+        self.waiting += 1
+        self.waits += 1
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "queue": self.waiting,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "max_wait": self.max_wait,
+        }
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose tokens live in a shared `multiprocessing.Array`
+    of (tokens, updated), so several processes draw on one budget."""
+
+    def __init__(self, limit: int, state, period: float = RATE_LIMIT_PERIOD) -> None:
+        super().__init__(limit, period)
+        self.state = state
+
+    def reserve(self) -> float:
+        with self.state.get_lock():
+            tokens, updated = self.state[0], self.state[1]
+            now = time.monotonic()
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate) - 1
+            self.state[0] = tokens
+            self.state[1] = now
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+
+# OKX accepts at most 20 orders per batch request.
+BATCH_MAX_SIZE = 20
+BATCH_WINDOW = 0.02
+
+
+class Coalescer:
+    """Collects single requests made within a short window and sends them
+    as one batch, handing each caller its own result.
+
+    send() gets the list of queued items and returns the batch response;
+    its data entries are matched to the items by position.
+    """
+
+    def __init__(
+        self,
+        send: Callable,
+        window: float = BATCH_WINDOW,
+        max_size: int = BATCH_MAX_SIZE,
+    ) -> None:
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.pending: List[tuple] = []
+        self.timer: asyncio.TimerHandle = None
+        # The loop only keeps weak references to tasks; these hold the
+        # in-flight batches until they are done.
+        self.sending: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_size:
+            self.__flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.window, self.__flush
+            )
+        return await future
+
+    def __flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if len(pending) != 0:
+            task = asyncio.ensure_future(self.__send(pending))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def __send(self, pending: List[tuple]):
+        self.batches += 1
+        self.items += len(pending)
+        try:
+            d = await self.send([item for item, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        data = d.get("data") or []
+        for i, (_, future) in enumerate(pending):
+            if future.done():
+                continue
+            if i < len(data):
+                future.set_result(data[i])
+            else:
+                future.set_result({"sCode": d.get("code"), "sMsg": d.get("msg")})
+
+
+INSTRUMENTS_TTL = 3600.0
+LEVERAGE_TTL = 60.0
+
+
+class MetadataCache:
+    """Process-wide instrument and leverage metadata.
+
+    Instruments are loaded for a whole instType in one request; leverage
+    info is kept for LEVERAGE_TTL seconds and dropped by set_leverage().
+    Each invalidation bumps the instId's generation, and a leverage answer
+    is only cached if no invalidation happened while it was in flight.
+    """
+
+    def __init__(self, client: "OKEX") -> None:
+        self.client = client
+        self.instruments: Dict[str, dict] = {}
+        self.instruments_time: Dict[str, float] = {}
+        self.leverage_info: Dict[tuple, tuple] = {}
+        self.leverage_generation: Dict[str, int] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    async def preload(self, instType: str):
+        d = await self.client.get_instruments(instType)
+        if d["code"] != "0":
+            raise ClientError("preload instruments code not 0. " + str(d))
+        for inst in d["data"]:
+            self.instruments[inst["instId"]] = inst
+        self.instruments_time[instType] = time.monotonic()
+
+    async def instrument(self, instType: str, instId: str) -> dict:
+        lock = self.locks.setdefault(instType, asyncio.Lock())
+        async with lock:
+            loaded = self.instruments_time.get(instType)
+            if loaded is None or time.monotonic() - loaded > INSTRUMENTS_TTL:
+                await self.preload(instType)
+        return self.instruments[instId]
+
+    def tick_size(self, instId: str) -> str:
+        return self.instruments[instId]["tickSz"]
+
+    def lot_size(self, instId: str) -> str:
+        return self.instruments[instId]["lotSz"]
+
+    def min_size(self, instId: str) -> str:
+        return self.instruments[instId]["minSz"]
+
+    async def leverage(self, instId: str, mgnMode: str) -> List[dict]:
+        key = (instId, mgnMode)
+        cached = self.leverage_info.get(key)
+        if cached is not None and time.monotonic() - cached[0] < LEVERAGE_TTL:
+            return cached[1]
+        generation = self.leverage_generation.get(instId, 0)
+        d = await self.client.get_leverage_info(instId, mgnMode)
+        if d["code"] != "0":
+            raise ClientError("get leverage info code not 0. " + str(d))
+        if self.leverage_generation.get(instId, 0) == generation:
+            self.leverage_info[key] = (time.monotonic(), d["data"])
+        return d["data"]
+
+    def invalidate_leverage(self, instId: str):
+        self.leverage_generation[instId] = self.leverage_generation.get(instId, 0) + 1
+        for key in [key for key in self.leverage_info if key[0] == instId]:
+            del self.leverage_info[key]
+
+
+WARMUP_CONNECTIONS = 4
+TRADE_PATH_PREFIXES = ("/api/v5/trade/", "/api/v5/account/")
+
 
 class OKEX:
     __API_METHOD_GET = "GET"
@@ -60,18 +316,127 @@ class OKEX:
         api_secretkey: str = None,
         api_passphrase: str = None,
         testnet: bool = False,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 60.0,
+        dns_cache_ttl: int = 300,
+        connect_timeout: float = 3.0,
+        market_read_timeout: float = 10.0,
+        trade_read_timeout: float = 5.0,
+        base_url: str = "https://www.okx.com",
     ) -> None:
         self.api_key = api_key
         self.api_secretkey = api_secretkey
         self.api_passphrase = api_passphrase
         self.testnet = testnet
+        self.signer = Signer(api_secretkey)
+        self.base_url = base_url
+        self.public_headers = {"x-simulated-trading": "1"} if testnet else {}
+        self.private_headers = {
+            **self.public_headers,
+            "CONTENT-TYPE": "application/json",
+            "OK-ACCESS-PASSPHRASE": api_passphrase or "",
+            "OK-ACCESS-KEY": api_key or "",
+        }
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.order_batcher = Coalescer(self.batch_orders)
+        self.cancel_batcher = Coalescer(self.cancel_batch_orders)
+        self.metadata = MetadataCache(self)
+
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.market_timeout = aiohttp.ClientTimeout(
+            connect=connect_timeout, sock_read=market_read_timeout
+        )
+        self.trade_timeout = aiohttp.ClientTimeout(
+            connect=connect_timeout, sock_read=trade_read_timeout
+        )
+        self.http: aiohttp.ClientSession = None
+        self.pool = {
+            "requests": 0,
+            "in_flight": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "dns_cache_hits": 0,
+            "dns_cache_misses": 0,
+        }
+
+    def __trace_config(self) -> aiohttp.TraceConfig:
+        pool = self.pool
+
+        def count(key: str, delta: int = 1):
+            async def on_event(session, ctx, params):
+                pool[key] += delta
+
+            return on_event
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(count("requests"))
+        trace.on_request_start.append(count("in_flight"))
+        trace.on_request_end.append(count("in_flight", -1))
+        trace.on_request_exception.append(count("in_flight", -1))
+        trace.on_connection_create_end.append(count("connections_created"))
+        trace.on_connection_reuseconn.append(count("connections_reused"))
+        trace.on_dns_cache_hit.append(count("dns_cache_hits"))
+        trace.on_dns_cache_miss.append(count("dns_cache_misses"))
+        return trace
 
     async def asyncinit(self) -> None:
-        self.http = aiohttp.ClientSession()
+        if self.http is not None and not self.http.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self.http = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.market_timeout,
+            trace_configs=[self.__trace_config()],
+        )
+
+    async def warmup(self, connections: int = WARMUP_CONNECTIONS) -> int:
+        """Open keep-alive connections ahead of the first real request.
+
+        Returns how many of the warm-up requests succeeded.
+        """
+        results = await asyncio.gather(
+            *[
+                self.__request(
+                    self.__API_METHOD_GET,
+                    "/api/v5/public/time",
+                    {},
+                    self.__SECURITY_TYPE_PUBLIC,
+                )
+                for _ in range(min(connections, self.limit_per_host))
+            ],
+            return_exceptions=True,
+        )
+        return len([r for r in results if not isinstance(r, Exception)])
+
+    def pool_stats(self) -> dict:
+        connector = self.http.connector if self.http is not None else None
+        return {
+            **self.pool,
+            "limit_per_host": self.limit_per_host,
+            "closed": connector is None or connector.closed,
+        }
 
     async def close(self) -> None:
         await self.http.close()
 
+    def bucket(self, urlpath: str) -> TokenBucket:
+        if urlpath not in self.buckets:
+            self.buckets[urlpath] = TokenBucket(
+                RATE_LIMITS.get(urlpath, DEFAULT_RATE_LIMIT)
+            )
+        return self.buckets[urlpath]
+
+    def rate_limit_stats(self) -> Dict[str, dict]:
+        """Queue depth and time spent waiting, per endpoint."""
+        return {path: bucket.stats() for path, bucket in self.buckets.items()}
+
     async def get_leverage_info(self, instId: str, mgnMode: str):
         return await self.__api(
             self.__API_METHOD_GET,
@@ -96,18 +461,24 @@ class OKEX:
         posSide: str = POS_SIDE_NET,
         ccy: str = None,
     ):
-        return await self.__api(
-            self.__API_METHOD_POST,
-            "/api/v5/account/set-leverage",
-            {
-                "instId": instId,
-                "ccy": ccy,
-                "lever": lever,
-                "posSide": posSide,
-                "mgnMode": mgnMode,
-            },
-            self.__SECURITY_TYPE_PRIVATE,
-        )
+        # Before the POST, so reads already in flight are not cached, and
+        # after it, for reads sent while it was in flight.
+        self.metadata.invalidate_leverage(instId)
+        try:
+            return await self.__api(
+                self.__API_METHOD_POST,
+                "/api/v5/account/set-leverage",
+                {
+                    "instId": instId,
+                    "ccy": ccy,
+                    "lever": lever,
+                    "posSide": posSide,
+                    "mgnMode": mgnMode,
+                },
+                self.__SECURITY_TYPE_PRIVATE,
+            )
+        finally:
+            self.metadata.invalidate_leverage(instId)
 
     async def get_orders_history(self):
         return await self.__api(
@@ -150,6 +521,55 @@ class OKEX:
             self.__SECURITY_TYPE_PRIVATE,
         )
 
+    async def batch_orders(self, orders: List[dict]):
+        """Place up to 20 orders, each a dict of the order() arguments."""
+        return await self.__api(
+            self.__API_METHOD_POST,
+            "/api/v5/trade/batch-orders",
+            orders,
+            self.__SECURITY_TYPE_PRIVATE,
+        )
+
+    async def cancel_batch_orders(self, orders: List[dict]):
+        """Cancel up to 20 orders, each a dict with instId and ordId or clOrdId."""
+        return await self.__api(
+            self.__API_METHOD_POST,
+            "/api/v5/trade/cancel-batch-orders",
+            orders,
+            self.__SECURITY_TYPE_PRIVATE,
+        )
+
+    async def order_coalesced(
+        self,
+        instId: str,
+        tdMode: str,
+        side: str,
+        ordType: str,
+        sz: str,
+        posSide: str = None,
+        px: str = None,
+    ) -> dict:
+        """Like order(), but sent together with orders placed by other tasks
+        in the same few milliseconds. Returns the order's own data entry."""
+        return await self.order_batcher.submit(
+            {
+                "instId": instId,
+                "tdMode": tdMode,
+                "side": side,
+                "ordType": ordType,
+                "sz": sz,
+                "posSide": posSide,
+                "px": px,
+            }
+        )
+
+    async def cancel_order_coalesced(
+        self, instId: str, ordId: str = None, clOrdId: str = None
+    ) -> dict:
+        return await self.cancel_batcher.submit(
+            {"instId": instId, "ordId": ordId, "clOrdId": clOrdId}
+        )
+
     async def get_order(self, instId: str = None, ordId: str = None):
         return await self.__api(
             self.__API_METHOD_GET,
@@ -184,7 +604,7 @@ class OKEX:
                 "bar": bar,
                 "after": after,
                 "before": before,
-                "limt": limt,
+                "limit": limt,
             },
             self.__SECURITY_TYPE_PUBLIC,
         )
@@ -205,57 +625,90 @@ class OKEX:
             self.__SECURITY_TYPE_PUBLIC,
         )
 
-    async def __api(self, method: str, urlpath: str, param: dict, security_type: str):
-        param = {k: v for k, v in param.items() if v is not None}
-
-        baseurl = "https://www.okx.com/"
-        url = urljoin(baseurl, urlpath)
-        headers = {}
-        if self.testnet:
-            headers["x-simulated-trading"] = "1"
-        if security_type != self.__SECURITY_TYPE_PUBLIC:
-
-            headers["CONTENT-TYPE"] = "application/json"
-            headers["OK-ACCESS-TIMESTAMP"] = datetime.utcnow().isoformat()[:-3] + "Z"
-            headers["OK-ACCESS-PASSPHRASE"] = self.api_passphrase
-            headers["OK-ACCESS-KEY"] = self.api_key
-
-            if method != self.__API_METHOD_POST:
-
-                headers["OK-ACCESS-SIGN"] = (
-                    headers["OK-ACCESS-TIMESTAMP"]
-                    + method
-                    + urlpath
-                    + ("" if param == {} else "?")
-                    + urlencode(param)
-                )
-            else:
-                headers["OK-ACCESS-SIGN"] = (
-                    headers["OK-ACCESS-TIMESTAMP"]
-                    + method
-                    + urlpath
-                    + json.dumps(param)
-                )
-            headers["OK-ACCESS-SIGN"] = base64.b64encode(
-                hmac.new(
-                    bytes(self.api_secretkey, encoding="utf-8"),
-                    bytes(headers["OK-ACCESS-SIGN"], encoding="utf-8"),
-                    digestmod="sha256",
-                ).digest()
-            ).decode("utf-8")
-
-        param = None if param == {} else param
-        headers = None if headers == {} else headers
+    def sign(self, prehash: str) -> str:
+        return self.signer.sign(bytes(prehash, encoding="utf-8"))
+
+    def prepare_request(
+        self, method: str, urlpath: str, param: Union[dict, List[dict]], private: bool
+    ) -> Tuple[URL, bytes, dict]:
+        """Build the URL, body and headers of a request.
+
+        The body and query string are serialized once, and those same bytes
+        are both signed and sent.
+        """
+        body = None
+        if method == self.__API_METHOD_POST:
+            path = urlpath
+            body = json_dumps(param)
+        elif param:
+            path = urlpath + "?" + urlencode(param)
+        else:
+            path = urlpath
+        url = URL(self.base_url + path, encoded=True)
+        if not private:
+            return url, body, self.public_headers
+
+        timestamp = (
+            datetime.now(timezone.utc).isoformat(timespec="milliseconds")[:-6] + "Z"
+        )
+        prehash = (timestamp + method + path).encode("utf-8")
+        if body is not None:
+            prehash += body
+        headers = dict(self.private_headers)
+        headers["OK-ACCESS-TIMESTAMP"] = timestamp
+        headers["OK-ACCESS-SIGN"] = self.signer.sign(prehash)
+        return url, body, headers
+
+    async def __api(
+        self,
+        method: str,
+        urlpath: str,
+        param: Union[dict, List[dict]],
+        security_type: str,
+    ):
+        if isinstance(param, list):
+            param = [{k: v for k, v in p.items() if v is not None} for p in param]
+        else:
+            param = {k: v for k, v in param.items() if v is not None}
+        for retry in range(RATE_LIMIT_RETRIES + 1):
+            await self.bucket(urlpath).acquire()
+            API_REQUESTS.inc(urlpath)
+            try:
+                with API_LATENCY.time(urlpath):
+                    status, d = await self.__request(
+                        method, urlpath, param, security_type
+                    )
+            except Exception:
+                API_ERRORS.inc(urlpath)
+                raise
+            if status != 429 and d.get("code") != RATE_LIMIT_CODE:
+                if d.get("code") != "0":
+                    API_ERRORS.inc(urlpath)
+                return d
+            API_RATE_LIMITED.inc(urlpath)
+            if retry < RATE_LIMIT_RETRIES:
+                await asyncio.sleep(RATE_LIMIT_BACKOFF * 2**retry)
+        raise ClientError("Rate limited", urlpath, d)
+
+    async def __request(
+        self, method: str, urlpath: str, param: dict, security_type: str
+    ):
+        url, body, headers = self.prepare_request(
+            method, urlpath, param, security_type != self.__SECURITY_TYPE_PUBLIC
+        )
+        timeout = (
+            self.trade_timeout
+            if urlpath.startswith(TRADE_PATH_PREFIXES)
+            else self.market_timeout
+        )
         async with self.http.request(
-            method=method,
-            url=url,
-            params=(param if method != self.__API_METHOD_POST else None),
-            data=(json.dumps(param) if method == self.__API_METHOD_POST else None),
-            headers=headers,
+            method=method, url=url, data=body, headers=headers, timeout=timeout
         ) as r:
-            text = await r.text()
+            content = await r.read()
+            if r.status == 429:
+                return r.status, {}
             try:
                 r.raise_for_status()
             except Exception as e:
-                raise ClientError(e, text)
-            return json.loads(text)
+                raise ClientError(e, content)
+            return r.status, json_loads(content)
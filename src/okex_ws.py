@@ -0,0 +1,367 @@
+import asyncio
+import json
+import time
+from typing import Dict, Set, Tuple
+import aiohttp
+from log import logger
+from okex import OKEX
+from kline_store import fetch_klines, kline_store
+
+WS_PUBLIC_URL = "wss://ws.okx.com:8443/ws/v5/public"
+WS_PUBLIC_TESTNET_URL = "wss://wspap.okx.com:8443/ws/v5/public?brokerId=9999"
+# OKX serves the candle channels here, not on the public endpoint.
+WS_BUSINESS_URL = "wss://ws.okx.com:8443/ws/v5/business"
+WS_BUSINESS_TESTNET_URL = "wss://wspap.okx.com:8443/ws/v5/business?brokerId=9999"
+WS_PRIVATE_URL = "wss://ws.okx.com:8443/ws/v5/private"
+WS_PRIVATE_TESTNET_URL = "wss://wspap.okx.com:8443/ws/v5/private?brokerId=9999"
+
+# OKX drops connections that are silent for 30 seconds.
+WS_PING_INTERVAL = 20.0
+WS_RECONNECT_DELAY = 1.0
+WS_RECONNECT_DELAY_MAX = 30.0
+
+ORDER_STATE_FILLED = "filled"
+ORDER_FINAL_STATES = ("filled", "canceled")
+ORDER_CACHE_SIZE = 1000
+
+
+class OKEXWebSocket:
+    """Reconnecting OKX WebSocket connection.
+
+    Subclasses provide the subscription args and handle pushed messages;
+    on every (re)connect the full subscription set is sent again and
+    on_connected() runs before any push is handled.
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.ws: aiohttp.ClientWebSocketResponse = None
+        self.connected = False
+        self.logger = logger.getChild(type(self).__name__)
+        self.__task: asyncio.Task = None
+
+    def subscription_args(self) -> list:
+        return []
+
+    async def on_connected(self):
+        pass
+
+    async def on_disconnected(self):
+        pass
+
+    async def on_message(self, msg: dict):
+        pass
+
+    async def on_event(self, msg: dict):
+        if msg["event"] == "error":
+            self.logger.warning(f"WebSocket error event: {msg}")
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def send(self, msg: dict):
+        await self.ws.send_str(json.dumps(msg))
+
+    async def subscribe(self, args: list):
+        if self.connected and len(args) != 0:
+            await self.send({"op": "subscribe", "args": args})
+
+    async def login(self):
+        pass
+
+    async def __run(self):
+        delay = WS_RECONNECT_DELAY
+        async with aiohttp.ClientSession() as http:
+            while True:
+                try:
+                    async with http.ws_connect(self.url) as ws:
+                        self.ws = ws
+                        await self.login()
+                        self.connected = True
+                        await self.subscribe(self.subscription_args())
+                        await self.on_connected()
+                        delay = WS_RECONNECT_DELAY
+                        await self.__read(ws)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.warning(f"WebSocket error: {e!r}")
+                finally:
+                    self.connected = False
+                    self.ws = None
+                    await self.on_disconnected()
+                self.logger.debug(f"WebSocket reconnecting in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WS_RECONNECT_DELAY_MAX)
+
+    async def __read(self, ws: aiohttp.ClientWebSocketResponse):
+        while True:
+            try:
+                msg = await ws.receive(timeout=WS_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                await ws.send_str("ping")
+                continue
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                return
+            if msg.data == "pong":
+                continue
+            d = json.loads(msg.data)
+            if "event" in d:
+                await self.on_event(d)
+            elif "data" in d:
+                await self.on_message(d)
+
+
+class TickerFeed(OKEXWebSocket):
+    """Public tickers channel, keeping the latest ticker of each instrument."""
+
+    def __init__(self, client: OKEX, url: str = None) -> None:
+        super().__init__(
+            url or (WS_PUBLIC_TESTNET_URL if client.testnet else WS_PUBLIC_URL)
+        )
+        self.tickers: Dict[str, dict] = {}
+        self.ticker_ids: Set[str] = set()
+
+    def subscription_args(self) -> list:
+        return [{"channel": "tickers", "instId": instId} for instId in self.ticker_ids]
+
+    async def subscribe_ticker(self, instId: str):
+        if instId in self.ticker_ids:
+            return
+        self.ticker_ids.add(instId)
+        await self.subscribe([{"channel": "tickers", "instId": instId}])
+
+    def ticker(self, instId: str) -> dict:
+        return self.tickers.get(instId) if self.connected else None
+
+    async def on_disconnected(self):
+        self.tickers.clear()
+
+    async def on_message(self, msg: dict):
+        if msg["arg"]["channel"] == "tickers":
+            self.tickers[msg["arg"]["instId"]] = msg["data"][-1]
+
+
+class MarketFeed(OKEXWebSocket):
+    """Candle channels on the business endpoint, with tickers on a second,
+    public connection.
+
+    Candles go straight into the shared kline stores; after every
+    (re)connect the stores are caught up over REST before they count as
+    live, and a candle only counts as live once OKX acknowledged its
+    subscription or pushed it, so a refused subscription falls back to REST
+    instead of leaving a store that never advances.
+    """
+
+    def __init__(self, client: OKEX, url: str = None, ticker_url: str = None) -> None:
+        super().__init__(
+            url or (WS_BUSINESS_TESTNET_URL if client.testnet else WS_BUSINESS_URL)
+        )
+        self.client = client
+        self.ticker_feed = TickerFeed(client, ticker_url)
+        self.candles: Set[Tuple[str, str]] = set()
+        self.synced: Set[Tuple[str, str]] = set()
+        self.subscribed: Set[Tuple[str, str]] = set()
+        self.bar_closed: Dict[Tuple[str, str], asyncio.Event] = {}
+        self.last_closed: Dict[Tuple[str, str], float] = {}
+
+    def subscription_args(self) -> list:
+        return [
+            {"channel": "candle" + bar, "instId": instId}
+            for instId, bar in self.candles
+        ]
+
+    def start(self):
+        super().start()
+        self.ticker_feed.start()
+
+    async def close(self):
+        await super().close()
+        await self.ticker_feed.close()
+
+    async def subscribe_candles(self, instId: str, bar: str):
+        key = (instId, bar)
+        if key in self.candles:
+            return
+        self.candles.add(key)
+        await self.subscribe([{"channel": "candle" + bar, "instId": instId}])
+        if self.connected:
+            await self.sync(instId, bar)
+
+    async def subscribe_ticker(self, instId: str):
+        await self.ticker_feed.subscribe_ticker(instId)
+
+    def live(self, instId: str, bar: str) -> bool:
+        key = (instId, bar)
+        return self.connected and key in self.synced and key in self.subscribed
+
+    def ticker(self, instId: str) -> dict:
+        return self.ticker_feed.ticker(instId)
+
+    async def wait_closed(self, instId: str, bar: str, timeout: float = None) -> bool:
+        """Wait for the next (instId, bar) candle to close."""
+        event = self.bar_closed.setdefault((instId, bar), asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def sync(self, instId: str, bar: str):
+        await fetch_klines(self.client, kline_store(instId, bar), instId, bar)
+        self.synced.add((instId, bar))
+
+    async def on_connected(self):
+        results = await asyncio.gather(
+            *[self.sync(instId, bar) for instId, bar in self.candles],
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, Exception):
+                self.logger.warning(f"Kline backfill failed: {r!r}")
+
+    async def on_disconnected(self):
+        self.synced.clear()
+        self.subscribed.clear()
+
+    async def on_event(self, msg: dict):
+        await super().on_event(msg)
+        arg = msg.get("arg", {})
+        channel = arg.get("channel", "")
+        if msg["event"] == "subscribe" and channel.startswith("candle"):
+            self.subscribed.add((arg["instId"], channel[len("candle") :]))
+
+    def __closed(self, key: Tuple[str, str], ot: float):
+        if self.last_closed.get(key, 0) >= ot:
+            return
+        self.last_closed[key] = ot
+        event = self.bar_closed.pop(key, None)
+        if event is not None:
+            event.set()
+
+    async def on_message(self, msg: dict):
+        arg = msg["arg"]
+        channel = arg["channel"]
+        if not channel.startswith("candle"):
+            return
+        key = (arg["instId"], channel[len("candle") :])
+        self.subscribed.add(key)
+        store = kline_store(*key)
+        for row in msg["data"]:
+            row = [float(v) for v in row]
+            last = store.last_time
+            if last is not None and row[0] > last:
+                # A new candle opened, so the previous one is final.
+                self.__closed(key, last)
+            store.append(row)
+            if len(row) > 8 and row[8]:
+                self.__closed(key, row[0])
+
+
+class AccountFeed(OKEXWebSocket):
+    """Private orders and positions channels.
+
+    Keeps the latest state of every order and position seen since the
+    last (re)connect, so tasks can await fills instead of polling.
+    """
+
+    def __init__(self, client: OKEX, url: str = None) -> None:
+        super().__init__(
+            url or (WS_PRIVATE_TESTNET_URL if client.testnet else WS_PRIVATE_URL)
+        )
+        self.client = client
+        self.orders: Dict[str, dict] = {}
+        self.order_updated: Dict[str, asyncio.Event] = {}
+        self.positions: Dict[Tuple[str, str], dict] = {}
+        self.positions_ready = False
+
+    @property
+    def live(self) -> bool:
+        return self.connected and self.positions_ready
+
+    def subscription_args(self) -> list:
+        return [
+            {"channel": "orders", "instType": "ANY"},
+            {"channel": "positions", "instType": "ANY"},
+        ]
+
+    async def login(self):
+        timestamp = str(time.time())
+        await self.send(
+            {
+                "op": "login",
+                "args": [
+                    {
+                        "apiKey": self.client.api_key,
+                        "passphrase": self.client.api_passphrase,
+                        "timestamp": timestamp,
+                        "sign": self.client.sign(
+                            timestamp + "GET" + "/users/self/verify"
+                        ),
+                    }
+                ],
+            }
+        )
+        d = json.loads(await self.ws.receive_str(timeout=10))
+        if d.get("event") != "login" or d.get("code") != "0":
+            raise Exception(f"WebSocket login failed: {d}")
+
+    async def on_disconnected(self):
+        self.positions_ready = False
+        self.positions.clear()
+
+    def position(self, instId: str) -> dict:
+        """The open position on instId, or None when there is none."""
+        for (id, _), position in self.positions.items():
+            if id == instId:
+                return position
+        return None
+
+    async def wait_order(self, ordId: str, timeout: float) -> dict:
+        """Wait until the order is filled or canceled, return its last state."""
+        deadline = time.monotonic() + timeout
+        while True:
+            order = self.orders.get(ordId)
+            if order is not None and order["state"] in ORDER_FINAL_STATES:
+                return order
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return order
+            event = self.order_updated.setdefault(ordId, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def on_message(self, msg: dict):
+        channel = msg["arg"]["channel"]
+        if channel == "orders":
+            for order in msg["data"]:
+                ordId = order["ordId"]
+                self.orders.pop(ordId, None)
+                self.orders[ordId] = order
+                if len(self.orders) > ORDER_CACHE_SIZE:
+                    # Oldest first; a fill can land before anyone waits on it,
+                    # so final orders are kept for a while too.
+                    self.orders.pop(next(iter(self.orders)))
+                event = self.order_updated.pop(ordId, None)
+                if event is not None:
+                    event.set()
+        elif channel == "positions":
+            for position in msg["data"]:
+                key = (position["instId"], position["posSide"])
+                if position["pos"] in ("", "0"):
+                    self.positions.pop(key, None)
+                else:
+                    self.positions[key] = position
+            self.positions_ready = True
@@ -1,7 +1,12 @@
+import math
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
 from pandas import Series, DataFrame
 from ta.volatility import AverageTrueRange
 from ta.trend import EMAIndicator
 
+from indicators import ATR, CMO, CMO_LENGTH, Stateful, njit
+
 
 def pmax(
     high: Series,
@@ -49,7 +54,8 @@ def pmax(
         for i in range(0, 9):
             vDD += df.iloc[index - i]["vdd1"]
         df.at[index, "vDD"] = vDD
-        vCMO = (vUD - vDD) / (vUD + vDD)
+        # A flat window has no CMO; the MA then holds, see PMax.
+        vCMO = (vUD - vDD) / (vUD + vDD) if vUD + vDD != 0 else 0.0
         df.at[index, "CMO"] = vCMO
         VAR = (valpha * abs(vCMO) * src) + (1 - valpha * abs(vCMO)) * row1["MA"]
         df.at[index, "MA"] = VAR
@@ -73,3 +79,184 @@ def pmax(
         df.at[index, "PMax"] = Pmax
 
     return df["PMax"], df["MA"], df["dir"], df["src"]
+
+
+@njit(cache=True)
+def _stops_loop(
+    src: np.ndarray,
+    atr: np.ndarray,
+    abs_cmo: np.ndarray,
+    valpha: float,
+    atr_multiplier: float,
+    start: int,
+):
+    n = len(src)
+    pm = np.full(n, np.nan)
+    ma = np.zeros(n)
+    dir = np.ones(n, dtype=np.int64)
+    long_stop = np.full(n, np.nan)
+    short_stop = np.full(n, np.nan)
+    prev_ma = 0.0
+    prev_dir = 1
+    for i in range(start, n):
+        k = valpha * abs_cmo[i]
+        VAR = k * src[i] + (1 - k) * prev_ma
+        ls = VAR - atr_multiplier * atr[i]
+        lsp = ls if i == start else long_stop[i - 1]
+        ls = max(lsp, ls) if VAR > lsp else ls
+        ss = VAR + atr_multiplier * atr[i]
+        ssp = ss if i == start else short_stop[i - 1]
+        ss = min(ssp, ss) if VAR < ssp else ss
+        if prev_dir == -1 and VAR > ssp:
+            prev_dir = 1
+        elif prev_dir == 1 and VAR < lsp:
+            prev_dir = -1
+        ma[i] = VAR
+        long_stop[i] = ls
+        short_stop[i] = ss
+        dir[i] = prev_dir
+        pm[i] = ls if prev_dir == 1 else ss
+        prev_ma = VAR
+    return pm, ma, dir, long_stop, short_stop
+
+
+def _pmax_arrays(
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    atr: ATR,
+    cmo: CMO,
+    atr_multiplier: float,
+    ma_length: int,
+):
+    high = np.ascontiguousarray(high, dtype=np.float64)
+    low = np.ascontiguousarray(low, dtype=np.float64)
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    # pmax() takes ta's ATR, which is 0 until it has a full window.
+    atr_values = np.nan_to_num(atr.seed(high, low, close), nan=0.0)
+    src = (high + low) / 2
+    abs_cmo = np.nan_to_num(np.abs(cmo.seed(src)), nan=0.0)
+    pm, ma, dir, long_stop, short_stop = _stops_loop(
+        src,
+        atr_values,
+        abs_cmo,
+        2 / (ma_length + 1),
+        float(atr_multiplier),
+        cmo.length,
+    )
+    return pm, ma, dir, src, long_stop, short_stop
+
+
+def pmax_batch(
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    atr_length: int,
+    atr_multiplier: float,
+    ma_length: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """pmax() over float64 arrays, for full recomputes and parameter sweeps.
+
+    Returns (PMax, MA, dir, src) arrays; PMax is nan where pmax() gives None.
+    """
+    return _pmax_arrays(
+        high, low, close, ATR(atr_length), CMO(), atr_multiplier, ma_length
+    )[:4]
+
+
+class PMax(Stateful):
+    """Incremental PMax, fed one closed candle at a time.
+
+    Produces the same values as pmax() does for the same series, but keeps
+    the ATR and CMO indicators, VAR, longStop/shortStop and dir as state so
+    every update is O(1).
+
+    When hl2 did not move over the whole CMO window the CMO is 0/0; it is
+    taken as 0 there, so VAR holds its last value instead of turning nan,
+    which would carry on into every later bar of the incremental state.
+    """
+
+    cmo_length = CMO_LENGTH
+
+    def __init__(self, atr_length: int, atr_multiplier: float, ma_length: int):
+        self.atr_length = atr_length
+        self.atr_multiplier = atr_multiplier
+        self.ma_length = ma_length
+        self.valpha = 2 / (ma_length + 1)
+
+        self.count = 0
+        self.atr = ATR(atr_length)
+        self.cmo = CMO(self.cmo_length)
+        self.ma = 0.0
+        self.long_stop = None
+        self.short_stop = None
+        self.dir = 1
+
+    def update(
+        self, high: float, low: float, close: float
+    ) -> Tuple[Optional[float], float, int, float]:
+        """Feed one closed candle, return its (PMax, MA, dir, src)."""
+        self.atr.update(high, low, close)
+        src = (high + low) / 2
+        vCMO = self.cmo.update(src)
+        self.count += 1
+        if vCMO is None:
+            return None, self.ma, self.dir, src
+        if math.isnan(vCMO):
+            vCMO = 0.0
+
+        atr = self.atr.value
+        valpha = self.valpha
+        VAR = (valpha * abs(vCMO) * src) + (1 - valpha * abs(vCMO)) * self.ma
+        self.ma = VAR
+
+        longStop = VAR - self.atr_multiplier * atr
+        longStopPrev = longStop if self.long_stop is None else self.long_stop
+        longStop = max(longStopPrev, longStop) if VAR > longStopPrev else longStop
+        self.long_stop = longStop
+        shortStop = VAR + self.atr_multiplier * atr
+        shortStopPrev = shortStop if self.short_stop is None else self.short_stop
+        shortStop = min(shortStopPrev, shortStop) if VAR < shortStopPrev else shortStop
+        self.short_stop = shortStop
+
+        dir = self.dir
+        dir = (
+            1
+            if dir == -1 and VAR > shortStopPrev
+            else (-1 if dir == 1 and VAR < longStopPrev else dir)
+        )
+        self.dir = dir
+        Pmax = longStop if dir == 1 else shortStop
+        return Pmax, VAR, dir, src
+
+    def seed(
+        self, high: Iterable[float], low: Iterable[float], close: Iterable[float]
+    ) -> List[Tuple[Optional[float], float, int, float]]:
+        """Feed a run of closed candles, oldest first."""
+        if self.count != 0:
+            return [self.update(h, l, c) for h, l, c in zip(high, low, close)]
+        high = np.asarray(high, dtype=np.float64)
+        low = np.asarray(low, dtype=np.float64)
+        close = np.asarray(close, dtype=np.float64)
+        n = len(close)
+        if n <= max(self.cmo_length, self.atr_length):
+            return [self.update(h, l, c) for h, l, c in zip(high, low, close)]
+
+        pm, ma, dir, src, long_stop, short_stop = _pmax_arrays(
+            high,
+            low,
+            close,
+            self.atr,
+            self.cmo,
+            self.atr_multiplier,
+            self.ma_length,
+        )
+        self.count = n
+        self.ma = float(ma[-1])
+        self.long_stop = float(long_stop[-1])
+        self.short_stop = float(short_stop[-1])
+        self.dir = int(dir[-1])
+
+        pm = pm.tolist()
+        pm[: self.cmo_length] = [None] * self.cmo_length
+        return list(zip(pm, ma.tolist(), dir.tolist(), src.tolist()))
@@ -0,0 +1,114 @@
+from decimal import Decimal
+import math
+import sys
+from typing import Tuple, Union
+import numpy as np
+
+ROUND_DOWN = "down"
+ROUND_UP = "up"
+ROUND_NEAREST = "nearest"
+
+# Quotients this close to a whole number of steps are taken as exact, so
+# 0.3 / 0.1 is 3 steps rather than 2.9999999999999996. The tolerance is in
+# steps, widened only by the division's own rounding error (a few ulps of
+# the quotient), so it never overrides the rounding direction.
+STEP_EPSILON = 1e-9
+STEP_ULPS = 4 * sys.float_info.epsilon
+
+
+def step_units(step: str) -> Tuple[int, int]:
+    """("0.005") -> (5, 3): the step as an integer count of 10^-places."""
+    _, digits, exponent = Decimal(step).normalize().as_tuple()
+    units = int("".join(map(str, digits)))
+    if exponent > 0:
+        return units * 10**exponent, 0
+    return units, -exponent
+
+
+def to_steps(value: float, step: float, rounding: str = ROUND_DOWN) -> int:
+    q = value / step
+    n = round(q)
+    if abs(q - n) <= max(STEP_EPSILON, STEP_ULPS * abs(q)):
+        return n
+    if rounding == ROUND_DOWN:
+        return math.floor(q)
+    if rounding == ROUND_UP:
+        return math.ceil(q)
+    if rounding == ROUND_NEAREST:
+        return n
+    raise ValueError(f"Unknown rounding {rounding}")
+
+
+def to_steps_array(
+    values: np.ndarray, step: float, rounding: str = ROUND_DOWN
+) -> np.ndarray:
+    """to_steps over an array, as int64."""
+    q = np.asarray(values, dtype=np.float64) / step
+    n = np.rint(q)
+    exact = np.abs(q - n) <= np.maximum(STEP_EPSILON, STEP_ULPS * np.abs(q))
+    if rounding == ROUND_DOWN:
+        rounded = np.floor(q)
+    elif rounding == ROUND_UP:
+        rounded = np.ceil(q)
+    elif rounding == ROUND_NEAREST:
+        rounded = n
+    else:
+        raise ValueError(f"Unknown rounding {rounding}")
+    return np.where(exact, n, rounded).astype(np.int64)
+
+
+def format_steps(n: int, units: int, places: int) -> str:
+    """n steps of units * 10^-places as a plain decimal string."""
+    value = n * units
+    if places == 0:
+        return str(value)
+    sign = "-" if value < 0 else ""
+    whole, frac = divmod(abs(value), 10**places)
+    frac = f"{frac:0{places}d}".rstrip("0")
+    return f"{sign}{whole}.{frac}" if frac else f"{sign}{whole}"
+
+
+class Precision:
+    """Price and size arithmetic of one instrument in whole ticks and lots.
+
+    Prices and sizes are converted to integer tick/lot counts once, rounded
+    in an explicit direction, and formatted back to exchange strings from
+    the integers, so no float artifacts reach an order.
+    """
+
+    def __init__(self, tickSz: str, lotSz: str, minSz: str) -> None:
+        self.tick_units, self.tick_places = step_units(tickSz)
+        self.lot_units, self.lot_places = step_units(lotSz)
+        self.tick = float(tickSz)
+        self.lot = float(lotSz)
+        self.min_lots = to_steps(float(minSz), self.lot, ROUND_UP)
+
+    @classmethod
+    def from_instrument(cls, instrument: dict) -> "Precision":
+        return cls(instrument["tickSz"], instrument["lotSz"], instrument["minSz"])
+
+    def ticks(self, price: Union[float, str], rounding: str = ROUND_DOWN) -> int:
+        return to_steps(float(price), self.tick, rounding)
+
+    def lots(self, sz: Union[float, str], rounding: str = ROUND_DOWN) -> int:
+        return to_steps(float(sz), self.lot, rounding)
+
+    def format_price(self, ticks: int) -> str:
+        return format_steps(ticks, self.tick_units, self.tick_places)
+
+    def format_size(self, lots: int) -> str:
+        return format_steps(lots, self.lot_units, self.lot_places)
+
+    def price(self, price: Union[float, str], rounding: str = ROUND_DOWN) -> str:
+        return self.format_price(self.ticks(price, rounding))
+
+    def size(self, sz: Union[float, str], rounding: str = ROUND_DOWN) -> str:
+        return self.format_size(self.lots(sz, rounding))
+
+    def prices(self, prices: np.ndarray, rounding: str = ROUND_DOWN) -> np.ndarray:
+        """Vectorized price(), as floats on the tick grid."""
+        return to_steps_array(prices, self.tick, rounding) * self.tick
+
+    def sizes(self, sizes: np.ndarray, rounding: str = ROUND_DOWN) -> np.ndarray:
+        """Vectorized size(), as floats on the lot grid."""
+        return to_steps_array(sizes, self.lot, rounding) * self.lot
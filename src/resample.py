@@ -0,0 +1,127 @@
+import asyncio
+import time
+from typing import Dict
+from kline_store import KlineStore, fetch_klines, kline_store
+from log import logger
+from okex import OKEX
+
+BASE_BAR = "1m"
+BASE_MS = 60000
+
+# Bars built from BASE_BAR, with their length and bucket offset in ms. OKX
+# aligns bars to UTC except 6H and longer without the "utc" suffix, which
+# follow Hong Kong time (UTC+8).
+RESAMPLE_BARS = {
+    "3m": (180000, 0),
+    "5m": (300000, 0),
+    "15m": (900000, 0),
+    "30m": (1800000, 0),
+    "1H": (3600000, 0),
+    "2H": (7200000, 0),
+    "4H": (14400000, 0),
+    "6Hutc": (21600000, 0),
+    "12Hutc": (43200000, 0),
+    "1Dutc": (86400000, 0),
+    "6H": (21600000, -8 * 3600000),
+    "12H": (43200000, -8 * 3600000),
+    "1D": (86400000, -8 * 3600000),
+}
+
+
+def bucket_start(ot: int, bar: str) -> int:
+    """Open time of the bar that the 1m candle opening at ot belongs to."""
+    bar_ms, offset = RESAMPLE_BARS[bar]
+    return (ot - offset) // bar_ms * bar_ms + offset
+
+
+class Resampler:
+    """Builds the closed candles of longer bars from one instrument's 1m store.
+
+    Each derived store starts from one REST backfill of its own bar; after
+    that every bucket that has fully closed in the 1m store is aggregated
+    locally, so all bars of an instrument share a single upstream feed. The
+    1m store is grown to hold at least one whole bucket of the longest bar.
+    """
+
+    def __init__(self, instId: str) -> None:
+        self.instId = instId
+        self.base = kline_store(instId, BASE_BAR)
+        self.stores: Dict[str, KlineStore] = {}
+        self.lock = asyncio.Lock()
+        self.built = 0
+        self.fetched = 0
+
+    def store(self, bar: str) -> KlineStore:
+        if bar not in self.stores:
+            bar_ms, _ = RESAMPLE_BARS[bar]
+            self.base.reserve(bar_ms // BASE_MS + 100)
+            self.stores[bar] = kline_store(self.instId, bar)
+        return self.stores[bar]
+
+    def __aggregate(self, start: int, bar_ms: int) -> list:
+        """The [start, start + bar_ms) candle, or None if the 1m store does
+        not reach back to start."""
+        ot = self.base.view("Open Time")
+        if len(ot) == 0 or ot[0] > start:
+            return None
+        lo = ot.searchsorted(start, side="left")
+        hi = ot.searchsorted(start + bar_ms, side="left")
+        if lo == hi:
+            return None
+        view = self.base.view
+        return [
+            start,
+            view("Open")[lo],
+            view("High")[lo:hi].max(),
+            view("Low")[lo:hi].min(),
+            view("Close")[hi - 1],
+            view("Volume")[lo:hi].sum(),
+            view("VolumeCcy")[lo:hi].sum(),
+            view("volCcyQuote")[lo:hi].sum(),
+            1.0,
+        ]
+
+    async def __sync_base(self, client: OKEX, feed):
+        if feed is not None and feed.live(self.instId, BASE_BAR):
+            return
+        last = self.base.last_confirmed_time()
+        closed = (int(time.time() * 1000) // BASE_MS - 1) * BASE_MS
+        if last is not None and last >= closed:
+            # Another bar of this instrument already fetched it.
+            return
+        await fetch_klines(client, self.base, self.instId, BASE_BAR)
+
+    async def update(self, client: OKEX, bar: str, feed=None) -> KlineStore:
+        """Bring the bar's store up to the last closed 1m candle."""
+        store = self.store(bar)
+        async with self.lock:
+            await self.__sync_base(client, feed)
+            last = store.last_confirmed_time()
+            if last is None:
+                self.fetched += 1
+                return await fetch_klines(client, store, self.instId, bar)
+            bar_ms, _ = RESAMPLE_BARS[bar]
+            base_last = self.base.last_confirmed_time()
+            start = bucket_start(last, bar) + bar_ms
+            while base_last is not None and start + bar_ms <= base_last + BASE_MS:
+                row = self.__aggregate(start, bar_ms)
+                if row is None:
+                    logger.debug(
+                        f"{self.instId}/{bar} 1m klines miss {start}, fetching"
+                    )
+                    self.fetched += 1
+                    return await fetch_klines(client, store, self.instId, bar)
+                store.append(row)
+                self.built += 1
+                start += bar_ms
+            return store
+
+
+resamplers: Dict[str, Resampler] = {}
+
+
+def resampler(instId: str) -> Resampler:
+    """The shared resampler of an instrument."""
+    if instId not in resamplers:
+        resamplers[instId] = Resampler(instId)
+    return resamplers[instId]
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from typing import Dict, List, Set
+from compute import loop_lag
+from log import logger
+from okex_ws import MarketFeed
+from task import Task
+
+DEFAULT_SETTLE_DELAY = 2.0
+
+
+class TaskStats:
+    """Per-task run metrics. Jitter is how late a run started after its bar
+    closed, loop lag how long the event loop stalled while it ran, both in
+    seconds."""
+
+    def __init__(self) -> None:
+        self.runs = 0
+        self.overruns = 0
+        self.skipped_bars = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_loop_lag = 0.0
+        self.max_loop_lag = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "skipped_bars": self.skipped_bars,
+            "last_jitter": self.last_jitter,
+            "avg_jitter": self.total_jitter / self.runs if self.runs else 0.0,
+            "max_jitter": self.max_jitter,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration,
+            "last_loop_lag": self.last_loop_lag,
+            "max_loop_lag": self.max_loop_lag,
+        }
+
+
+class BarScheduler:
+    """Runs every task right after its own bar closes.
+
+    Each task waits for its next bar boundary (plus a settle delay so the
+    exchange has published the final candle) in its own asyncio task, so a
+    slow task only delays itself. With a live MarketFeed the task wakes on
+    the pushed bar close instead, and the timer is only the fallback.
+    """
+
+    def __init__(
+        self,
+        tasks: List[Task],
+        feed: MarketFeed = None,
+        settle_delay: float = DEFAULT_SETTLE_DELAY,
+    ) -> None:
+        self.tasks = tasks
+        self.feed = feed
+        self.settle_delay = settle_delay
+        self.stats: Dict[str, TaskStats] = {}
+        self.running: Dict[Task, asyncio.Task] = {}
+        # Tasks in the middle of a run, which remove() lets finish.
+        self.busy: Set[Task] = set()
+
+    @staticmethod
+    def next_close(bar_s: float, now: float) -> float:
+        return (now // bar_s + 1) * bar_s
+
+    async def __wait(self, task: Task, close: float):
+        delay = close + self.settle_delay - time.time()
+        if self.feed is not None and self.feed.live(task.id, task.bar):
+            if await self.feed.wait_closed(task.id, task.bar, max(delay, 0)):
+                return
+            delay = close + self.settle_delay - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run_task(self, task: Task):
+        key = f"{task.id}/{task.bar}"
+        stats = self.stats.setdefault(key, TaskStats())
+        bar_s = task.barms / 1000
+        close = self.next_close(bar_s, time.time())
+        while task in self.running:
+            await self.__wait(task, close)
+            start = time.time()
+            jitter = start - close
+            lag = loop_lag.total_lag
+            self.busy.add(task)
+            try:
+                await task.run()
+            finally:
+                self.busy.discard(task)
+            end = time.time()
+            lag = loop_lag.total_lag - lag
+
+            stats.runs += 1
+            stats.last_jitter = jitter
+            stats.total_jitter += jitter
+            stats.max_jitter = max(stats.max_jitter, jitter)
+            stats.last_duration = end - start
+            stats.max_duration = max(stats.max_duration, end - start)
+            stats.last_loop_lag = lag
+            stats.max_loop_lag = max(stats.max_loop_lag, lag)
+
+            next_close = close + bar_s
+            if end > next_close:
+                skipped = int((end - next_close) // bar_s) + 1
+                stats.overruns += 1
+                stats.skipped_bars += skipped
+                task.logger.warning(
+                    f"Run took {end - start:.2f}s, overran the bar, skipping {skipped} bar(s)"
+                )
+                next_close = self.next_close(bar_s, end)
+            close = next_close
+
+    def add(self, task: Task):
+        """Start scheduling a task, also while run() is running."""
+        if task not in self.tasks:
+            self.tasks.append(task)
+        if task not in self.running:
+            self.running[task] = asyncio.create_task(self.run_task(task))
+
+    def remove(self, task: Task):
+        """Stop scheduling a task. A run in progress finishes first, so no
+        order is left half placed."""
+        if task in self.tasks:
+            self.tasks.remove(task)
+        runner = self.running.pop(task, None)
+        if runner is not None and task not in self.busy:
+            runner.cancel()
+        self.stats.pop(f"{task.id}/{task.bar}", None)
+
+    def metrics(self) -> Dict[str, dict]:
+        return {key: stats.as_dict() for key, stats in self.stats.items()}
+
+    async def run(self):
+        logger.debug(f"Scheduling {len(self.tasks)} tasks on bar close")
+        loop_lag.start()
+        for task in list(self.tasks):
+            self.add(task)
+        # Tasks come and go with add() and remove(); run until cancelled.
+        await asyncio.Event().wait()
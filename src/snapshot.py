@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List
+import numpy as np
+from compute import PMaxEntry
+from kline_store import kline_store, stores
+from log import logger
+from pmax import PMax
+from resample import BASE_BAR
+from task import Task
+
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_INTERVAL = 60.0
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(directory: str = SNAPSHOT_DIR, shard: int = None) -> str:
+    name = "state.npz" if shard is None else f"state-{shard}.npz"
+    return os.path.join(directory, name)
+
+
+def pmax_key(task: Task) -> tuple:
+    return (task.id, task.bar, task.atrl, task.atrm, task.mal)
+
+
+class Snapshot:
+    """Periodic snapshot of the tasks' warm state, for a quick restart.
+
+    Holds the kline stores, each PMax entry's state and values, and the
+    tasks' bookkeeping. Positions are left out: they always come from the
+    exchange, which may have moved while the bot was down. Arrays go into
+    an .npz with the rest as a JSON header, so nothing is pickled. The file
+    is written next to its final path and renamed over it, so a crash never
+    leaves half a snapshot.
+    After load() the first fetch_klines of a task only asks for the bars
+    since the snapshot.
+    """
+
+    def __init__(self, path: str, interval: float = SNAPSHOT_INTERVAL) -> None:
+        self.path = path
+        self.interval = interval
+        self.saved = 0
+
+    def collect(self, tasks: List[Task]) -> Dict[str, np.ndarray]:
+        """Copy out the state of tasks; runs on the event loop, so every
+        store and entry is taken between two updates."""
+        arrays: Dict[str, np.ndarray] = {}
+        meta = {
+            "version": SNAPSHOT_VERSION,
+            "time": int(time.time() * 1000),
+            "stores": [],
+            "pmax": [],
+            "tasks": [],
+        }
+        keys = set()
+        for task in tasks:
+            keys.add((task.id, task.bar))
+            if task.resampler is not None:
+                keys.add((task.id, BASE_BAR))
+        for instId, bar in sorted(keys):
+            store = stores.get((instId, bar))
+            if store is None or len(store) == 0:
+                continue
+            arrays[f"klines_{len(meta['stores'])}"] = store.rows().copy()
+            meta["stores"].append([instId, bar])
+        entries = {pmax_key(task): task.pmax for task in tasks}
+        for key, entry in entries.items():
+            if entry.state is None or len(entry.indicators) == 0:
+                continue
+            arrays[f"pmax_{len(meta['pmax'])}"] = entry.indicators.rows().copy()
+            meta["pmax"].append({"key": list(key), "state": entry.state.state()})
+        for task in tasks:
+            meta["tasks"].append(
+                {
+                    "id": task.id,
+                    "bar": task.bar,
+                    "last_sub_sz_time": task.last_sub_sz_time,
+                }
+            )
+        arrays["meta"] = np.array(json.dumps(meta))
+        return arrays
+
+    def write(self, arrays: Dict[str, np.ndarray]):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    async def save(self, tasks: List[Task]):
+        arrays = self.collect(tasks)
+        # Off the event loop; the arrays are copies.
+        await asyncio.get_running_loop().run_in_executor(None, self.write, arrays)
+        self.saved += 1
+
+    def load(self, tasks: List[Task]) -> int:
+        """Restore what the snapshot holds for tasks, return how many tasks
+        got their klines back. Stores that already hold rows are kept."""
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            meta = json.loads(str(arrays["meta"]))
+        except Exception as e:
+            logger.warning(f"Snapshot {self.path} unreadable, starting cold. {e!r}")
+            return 0
+        if meta.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"Snapshot {self.path} is of another version, ignored")
+            return 0
+
+        for i, (instId, bar) in enumerate(meta["stores"]):
+            store = kline_store(instId, bar)
+            if len(store) == 0:
+                store.load(arrays[f"klines_{i}"])
+        entries: Dict[tuple, PMaxEntry] = {pmax_key(task): task.pmax for task in tasks}
+        for i, item in enumerate(meta["pmax"]):
+            entry = entries.get(tuple(item["key"]))
+            if entry is None or entry.state is not None:
+                continue
+            _, _, atrl, atrm, mal = item["key"]
+            entry.state = PMax(atrl, atrm, mal)
+            entry.state.restore(item["state"])
+            entry.indicators.load(arrays[f"pmax_{i}"])
+        bookkeeping = {(item["id"], item["bar"]): item for item in meta["tasks"]}
+        restored = 0
+        for task in tasks:
+            item = bookkeeping.get((task.id, task.bar))
+            if item is not None:
+                task.last_sub_sz_time = item["last_sub_sz_time"]
+            if len(task.klines) != 0:
+                restored += 1
+        age = time.time() - meta["time"] / 1000
+        logger.info(
+            f"Restored {restored}/{len(tasks)} tasks from a snapshot {age:.0f}s old"
+        )
+        return restored
+
+    async def run(self, tasks: List[Task]):
+        """Save every interval seconds, and once more when cancelled."""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.save(tasks)
+                except Exception as e:
+                    logger.warning(f"Snapshot failed {e!r}")
+        finally:
+            try:
+                self.write(self.collect(tasks))
+            except Exception as e:
+                logger.warning(f"Snapshot failed {e!r}")
@@ -0,0 +1,101 @@
+import asyncio
+import multiprocessing
+import time
+from typing import Dict, List
+from config import Config, load_config, shard_task_list
+from log import forward_log, logger, share_log
+from okex import RATE_LIMITS
+
+SUPERVISOR_POLL_INTERVAL = 1.0
+SUPERVISOR_RESTART_DELAY = 1.0
+SUPERVISOR_RESTART_DELAY_MAX = 60.0
+# A shard that stayed up this long counts as healthy again.
+SUPERVISOR_STABLE_TIME = 300.0
+# How long a terminated shard gets for its final snapshot.
+SUPERVISOR_STOP_TIMEOUT = 10.0
+
+
+def run_shard(index: int, count: int, log_queue, rate_limits: dict):
+    from main import main
+
+    share_log(log_queue)
+    asyncio.run(main((index, count), rate_limits))
+
+
+class Supervisor:
+    """Runs task_list split over `workers` processes, one event loop each.
+
+    Every worker draws on the same per-endpoint token buckets, kept in
+    shared memory here, and sends its log records back here to be written
+    once. A worker that dies is restarted on its own, with backoff, while
+    the other shards keep trading.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.context = multiprocessing.get_context("spawn")
+        self.config = Config()
+        self.config.config = load_config()
+        self.workers = min(
+            workers, len({item["id"] for item in self.config.config["task_list"]})
+        )
+        self.log_queue = self.context.Queue()
+        self.rate_limits = {
+            path: self.context.Array("d", [limit, time.monotonic()])
+            for path, limit in RATE_LIMITS.items()
+        }
+        self.processes: List[multiprocessing.Process] = [None] * self.workers
+        self.started: Dict[int, float] = {}
+        self.delays: Dict[int, float] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.restarts = [0] * self.workers
+
+    def start_shard(self, index: int):
+        process = self.context.Process(
+            target=run_shard,
+            args=(index, self.workers, self.log_queue, self.rate_limits),
+            name=f"shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+
+    def check_shard(self, index: int):
+        process = self.processes[index]
+        now = time.monotonic()
+        if process.is_alive():
+            if now - self.started[index] > SUPERVISOR_STABLE_TIME:
+                self.delays.pop(index, None)
+            return
+        if index not in self.restart_at:
+            delay = self.delays.get(index, SUPERVISOR_RESTART_DELAY)
+            logger.warning(
+                f"Shard {index} exited with code {process.exitcode}, "
+                f"restarting in {delay}s"
+            )
+            self.delays[index] = min(delay * 2, SUPERVISOR_RESTART_DELAY_MAX)
+            self.restart_at[index] = now + delay
+        if now >= self.restart_at[index]:
+            del self.restart_at[index]
+            self.restarts[index] += 1
+            self.start_shard(index)
+
+    def run(self):
+        self.config.set_log()
+        forward_log(self.log_queue)
+        shards = shard_task_list(self.config.config["task_list"], self.workers)
+        for index, shard in enumerate(shards):
+            logger.debug(f"Shard {index}: " + ", ".join(item["id"] for item in shard))
+            self.start_shard(index)
+        try:
+            while True:
+                time.sleep(SUPERVISOR_POLL_INTERVAL)
+                for index in range(self.workers):
+                    self.check_shard(index)
+        finally:
+            for process in self.processes:
+                if process is not None and process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                if process is not None:
+                    process.join(SUPERVISOR_STOP_TIMEOUT)
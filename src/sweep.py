@@ -0,0 +1,213 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import logging
+from multiprocessing import shared_memory
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+import yaml
+from backtest import DEFAULT_INSTRUMENT, backtest_task
+from kline_archive import read_archive
+from log import logger
+
+SWEEP_DIR = "sweeps"
+SWEEP_COLUMNS = ("Open Time", "Open", "High", "Low", "Close", "Volume", "VolumeCcy")
+SWEEP_PARAMS = ("mal", "atrm", "atrl")
+DEFAULT_RANK_BY = "pnl"
+
+# Set in each worker by _init_worker().
+worker_candles: Dict[str, np.ndarray] = None
+worker_shm: shared_memory.SharedMemory = None
+
+
+def sweep_space(space: dict, samples: int = None, seed: int = 0) -> List[dict]:
+    """Every mal/atrm/atrl combination of the listed values, or `samples` of
+    them picked at random."""
+    values = [space[name] for name in SWEEP_PARAMS]
+    grid = [dict(zip(SWEEP_PARAMS, combo)) for combo in itertools.product(*values)]
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+def cache_path(instId: str, bar: str) -> str:
+    return os.path.join(SWEEP_DIR, f"{instId}_{bar}.jsonl")
+
+
+def cache_key(
+    params: dict,
+    data_key: list,
+    exchange_config: dict,
+    sz: str,
+    instrument: dict,
+) -> str:
+    """Everything a backtest result depends on besides the task's id and
+    bar, which pick the cache file."""
+    return json.dumps(
+        [
+            [params[name] for name in SWEEP_PARAMS],
+            data_key,
+            exchange_config,
+            sz,
+            {**DEFAULT_INSTRUMENT, **(instrument or {})},
+        ],
+        sort_keys=True,
+    )
+
+
+class SweepCache:
+    """Evaluated parameter sets of one (instId, bar), one JSON line each."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.results: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    d = json.loads(line)
+                    self.results[d["key"]] = d["report"]
+
+    def get(self, key: str) -> dict:
+        return self.results.get(key)
+
+    def put(self, key: str, report: dict):
+        self.results[key] = report
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": key, "report": report}) + "\n")
+
+
+def _init_worker(name: str, n: int):
+    global worker_candles, worker_shm
+    logger.setLevel(logging.INFO)
+    worker_shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((len(SWEEP_COLUMNS), n), dtype=np.float64, buffer=worker_shm.buf)
+    worker_candles = dict(zip(SWEEP_COLUMNS, data))
+
+
+def _evaluate(args: Tuple[dict, dict, dict, dict]) -> dict:
+    task_config, params, instrument, exchange_config = args
+    return asyncio.run(
+        backtest_task(
+            {**task_config, **params},
+            worker_candles,
+            instrument,
+            **exchange_config,
+        )
+    )
+
+
+def sweep(
+    task_config: dict,
+    candles: Dict[str, np.ndarray],
+    space: List[dict],
+    instrument: dict = None,
+    exchange_config: dict = None,
+    workers: int = None,
+    rank_by: str = DEFAULT_RANK_BY,
+) -> List[dict]:
+    """Backtest task_config with every parameter set in space, best first.
+
+    The candles are copied once into shared memory that every worker maps,
+    and results already in the sweep cache are not evaluated again.
+    """
+    exchange_config = exchange_config or {}
+    ot = np.asarray(candles["Open Time"])
+    n = len(ot)
+    data_key = [n, int(ot[0]), int(ot[-1])] if n else [0]
+    cache = SweepCache(cache_path(task_config["id"], task_config["bar"]))
+    keys = [
+        cache_key(params, data_key, exchange_config, task_config["sz"], instrument)
+        for params in space
+    ]
+    todo = [(k, params) for k, params in zip(keys, space) if cache.get(k) is None]
+
+    if len(todo) != 0:
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(1, len(SWEEP_COLUMNS) * n * 8)
+        )
+        try:
+            data = np.ndarray((len(SWEEP_COLUMNS), n), dtype=np.float64, buffer=shm.buf)
+            for i, name in enumerate(SWEEP_COLUMNS):
+                data[i] = candles[name]
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(shm.name, n),
+            ) as executor:
+                args = [
+                    (task_config, params, instrument, exchange_config)
+                    for _, params in todo
+                ]
+                for (k, _), report in zip(todo, executor.map(_evaluate, args)):
+                    cache.put(k, report)
+            del data
+        finally:
+            shm.close()
+            shm.unlink()
+
+    results = [{**params, **cache.get(k)} for k, params in zip(keys, space)]
+    results.sort(key=lambda r: r[rank_by], reverse=True)
+    return results
+
+
+def main(config_path: str = "config.yaml"):
+    with open(config_path, "r") as stream:
+        config = yaml.safe_load(stream)
+    backtest_config = config.get("backtest", {})
+    sweep_config = config.get("sweep", {})
+    instruments = backtest_config.get("instruments", {})
+    exchange_config = {
+        key: backtest_config[key]
+        for key in ("fee_rate", "slippage", "funding_rate")
+        if key in backtest_config
+    }
+    done = set()
+    for item in config["task_list"]:
+        task_config = {
+            key: item.get(key, config.get(key))
+            for key in ("id", "inst_type", "bar", "mal", "atrm", "atrl", "sz")
+        }
+        pair = (task_config["id"], task_config["bar"])
+        if pair in done:
+            continue
+        done.add(pair)
+        space_config = {**sweep_config, **item.get("sweep", {})}
+        space = sweep_space(
+            space_config,
+            space_config.get("samples"),
+            space_config.get("seed", 0),
+        )
+        start = time.perf_counter()
+        results = sweep(
+            task_config,
+            read_archive(*pair),
+            space,
+            instruments.get(task_config["id"]),
+            exchange_config,
+            space_config.get("workers"),
+            space_config.get("rank_by", DEFAULT_RANK_BY),
+        )
+        print(
+            f"{pair[0]}/{pair[1]}: {len(space)} parameter sets "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        for r in results[: space_config.get("top", 10)]:
+            print(
+                "  "
+                + ", ".join(
+                    f"{k} {v:.4f}" if isinstance(v, float) else f"{k} {v}"
+                    for k, v in r.items()
+                )
+            )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
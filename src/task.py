@@ -1,11 +1,11 @@
 import asyncio
+import logging
 import math
 from re import sub
 from typing import List, Union
 from decimal import Decimal
 from aiohttp import client
 from pandas.core.frame import DataFrame
-from ta.trend import ADXIndicator
 from log import logger
 import pandas as pd
 import traceback
@@ -20,17 +20,67 @@ from okex import (
     SIDE_BUY,
     SIDE_SELL,
 )
-from pmax import pmax
+from compute import PMAX_COLUMNS, PMaxEntry, pmax_entry
+from indicators import ADX
+from metrics import TASK_STAGE
+from okex_ws import ORDER_STATE_FILLED, AccountFeed, MarketFeed
+from kline_archive import KlineArchive, archive_path
+from kline_store import KlineStore, fetch_klines, kline_store
+from precision import ROUND_DOWN, ROUND_UP, Precision
+from resample import BASE_BAR, RESAMPLE_BARS, Resampler, resampler
+
+# What refresh_positions stores when there is no open position.
+EMPTY_POSITIONS = {
+    "adl": "",
+    "availPos": "",
+    "avgPx": "",
+    "cTime": "",
+    "ccy": "",
+    "deltaBS": "",
+    "deltaPA": "",
+    "gammaBS": "",
+    "gammaPA": "",
+    "imr": "",
+    "instId": "",
+    "instType": "",
+    "interest": "0",
+    "last": "",
+    "lever": "",
+    "liab": "",
+    "liabCcy": "",
+    "liqPx": "",
+    "margin": "",
+    "markPx": "",
+    "mgnMode": "",
+    "mgnRatio": "",
+    "mmr": "",
+    "notionalUsd": "",
+    "optVal": "",
+    "pos": "",
+    "posCcy": "",
+    "posId": "",
+    "posSide": "",
+    "thetaBS": "",
+    "thetaPA": "",
+    "tradeId": "",
+    "uTime": "",
+    "upl": "",
+    "uplRatio": "",
+    "usdPx": "",
+    "vegaBS": "",
+    "vegaPA": "",
+}
 
+# Bar length in ms.
 stm = {
-    "1m": 600000,
-    "5m": 3000000,
-    "15m": 9000000,
-    "30m": 18000000,
-    "1H": 36000000,
-    "2H": 72000000,
-    "4H": 144000000,
-    "1Dutc": 864000000,
+    "1m": 60000,
+    "5m": 300000,
+    "15m": 900000,
+    "30m": 1800000,
+    "1H": 3600000,
+    "2H": 7200000,
+    "4H": 14400000,
+    "1Dutc": 86400000,
 }
 
 
@@ -62,150 +112,119 @@ class Task:
         atrm: int,
         atrl: int,
         sz: str,
-        candles_lock: asyncio.Lock,
+        feed: MarketFeed = None,
+        account: AccountFeed = None,
+        archive: bool = True,
+        resample: bool = False,
     ) -> None:
         self.atrl = atrl
         self.sz = sz
         self.client = client
+        self.feed = feed
+        self.account = account
         self.inst_type = inst_type
         self.id = id
         self.bar = bar
         self.mal = mal
         self.atrm = atrm
-        self.candles_lock = candles_lock
 
         self.barms = stm[bar]
 
-        self.logger = logger.getChild(
-            f"Task({id}/{bar}/sz({sz})/mal({mal})/atrm({atrm}))"
-        )
+        self.logger = self.__logger()
         self.logger.debug("Task init")
 
         self.positions = None
         self.ratio = 0.0
-        self.klines_cache = pd.DataFrame(
-            columns=(
-                "Open Time",
-                "Open",
-                "High",
-                "Low",
-                "Close",
-                "Volume",
-                "VolumeCcy",
-            )
-        )
-        self.indicators_cache: DataFrame = None
-        self.indicators_cache_time = None
+        # With resample, bars longer than 1m are built from the shared 1m
+        # store, and the feed only needs the 1m channel.
+        self.resampler: Resampler = None
+        self.feed_bar = bar
+        if resample and bar in RESAMPLE_BARS:
+            self.resampler = resampler(id)
+            self.feed_bar = BASE_BAR
+            self.klines = self.resampler.store(bar)
+        else:
+            self.klines = kline_store(id, bar)
+        self.pmax: PMaxEntry = pmax_entry(id, bar, atrl, atrm, mal)
+        self.archive: KlineArchive = None
+        self.archive_enabled = archive
         self.last_sub_sz_time = 0.0
         pass
 
-    async def asyncinit(self):
-        self.instruments = (
-            await self.client.get_instruments(self.inst_type, None, self.id)
-        )["data"][0]
+    def __logger(self) -> logging.LoggerAdapter:
+        return logging.LoggerAdapter(
+            logger.getChild(
+                f"Task({self.id}/{self.bar}/sz({self.sz})/mal({self.mal})/atrm({self.atrm}))"
+            ),
+            {"task": f"{self.id}/{self.bar}", "instId": self.id, "bar": self.bar},
+        )
 
-    async def candles(
-        self,
-        instId: str,
-        bar: str = None,
-        after: str = None,
-        before: str = None,
-        limt: int = 100,
-    ):
-        async with self.candles_lock:
-            candles = await self.client.candles(
-                instId=instId, bar=bar, after=after, before=before, limt=limt
-            )
-            await asyncio.sleep(0.1)
-        return candles
+    def update(self, mal: int, atrm: int, atrl: int, sz: str) -> bool:
+        """Apply reloaded settings in place, return whether any changed.
 
-    async def get_thousand_kline(self) -> DataFrame:
-        client = self.client
-        klines = pd.DataFrame(
-            columns=(
-                "Open Time",
-                "Open",
-                "High",
-                "Low",
-                "Close",
-                "Volume",
-                "VolumeCcy",
-            )
-        )
-        end = None
-        if len(self.klines_cache.index) != 0:
-            end = (int)(self.klines_cache.iloc[2]["Open Time"])
-        before = None
-        after = None
-        for _ in range(10):
-
-            if end != None and before != None and before < end:
-                klines = klines.append(self.klines_cache, ignore_index=True)
-                klines = klines.drop_duplicates(subset=["Open Time"], ignore_index=True)
-                break
-            candles = await self.candles(
-                self.id,
-                self.bar,
-                after=after,
-                before=before,
-                limt=100,
-            )
-            if candles["code"] != "0":
-                raise Exception("get_thousand_kline code not 0. " + str(candles))
-
-            klines = klines.append(
-                DataFrame(
-                    candles["data"],
-                    dtype=float,
-                    columns=(
-                        "Open Time",
-                        "Open",
-                        "High",
-                        "Low",
-                        "Close",
-                        "Volume",
-                        "VolumeCcy","volCcyQuote","confirm",
-                    ),
-                ),
-                ignore_index=True,
-            )
+        The klines are kept; new PMax parameters switch to the entry of that
+        parameter set, which seeds itself on the next run.
+        """
+        if (mal, atrm, atrl, sz) == (self.mal, self.atrm, self.atrl, self.sz):
+            return False
+        if (mal, atrm, atrl) != (self.mal, self.atrm, self.atrl):
+            self.pmax = pmax_entry(self.id, self.bar, atrl, atrm, mal)
+        self.mal = mal
+        self.atrm = atrm
+        self.atrl = atrl
+        self.sz = sz
+        self.logger = self.__logger()
+        return True
 
-            # self.logger.debug(f"Get k{str(klines)}")
-            after = (int)(klines.iloc[-1]["Open Time"])
-            before = after - (self.barms * 11)
-        if len(klines.index) > 1000:
-            klines = klines.head(1000)
-        # logger.debug(f"{self.id}\n{str(klines)}")
-        self.klines_cache = klines
-        klines = klines.loc[::-1].set_index(klines.index)
+    async def asyncinit(self):
+        self.instruments = await self.client.metadata.instrument(
+            self.inst_type, self.id
+        )
+        self.precision = Precision.from_instrument(self.instruments)
 
-        klines["Open Time"] = pd.to_datetime(klines["Open Time"], unit="ms", utc=True)
-        return klines
+    async def get_thousand_kline(self) -> KlineStore:
+        if self.resampler is not None:
+            return await self.resampler.update(self.client, self.bar, self.feed)
+        if self.feed is not None and self.feed.live(self.id, self.bar):
+            return self.klines
+        return await fetch_klines(self.client, self.klines, self.id, self.bar)
 
     def init_adx_indicators(self, klines: DataFrame) -> DataFrame:
-        adx = ADXIndicator(klines["High"], klines["Low"], klines["Close"], window=28)
-        klines["adx"] = adx.adx()
-        klines["adx_neg"] = adx.adx_neg()
-        klines["adx_pos"] = adx.adx_pos()
+        adx, adx_pos, adx_neg = ADX(window=28).seed(
+            klines["High"], klines["Low"], klines["Close"]
+        )
+        klines["adx"] = adx
+        klines["adx_neg"] = adx_neg
+        klines["adx_pos"] = adx_pos
         return klines
 
-    def init_indicators(self, klines: DataFrame) -> DataFrame:
-        last_ot = klines.iloc[-2]["Open Time"]
-        if self.indicators_cache_time == last_ot:
-            return self.indicators_cache
-        klines["PMax"], klines["PMax_MA"], klines["PMax_dir"], klines["hl2"] = pmax(
-            klines["High"],
-            klines["Low"],
-            klines["Close"],
-            self.atrl,
-            self.atrm,
-            self.mal,
-        )
+    @property
+    def indicators(self) -> KlineStore:
+        return self.pmax.indicators
+
+    async def init_indicators(self, klines: KlineStore) -> KlineStore:
+        """Feed the closed bars not seen yet into the incremental PMax."""
+        indicators = await self.pmax.update(klines, self.atrl, self.atrm, self.mal)
         # klines = self.init_adx_indicators(klines)
+        return indicators
 
-        self.indicators_cache_time = last_ot
-        self.indicators_cache = klines
-        return klines
+    def archive_bars(self, klines: KlineStore, indicators: KlineStore):
+        """Append the closed bars not archived yet, with their PMax values."""
+        if not self.archive_enabled:
+            return
+        if self.archive is None:
+            self.archive = KlineArchive(archive_path(self.id, self.bar))
+        ot = indicators.view("Open Time")
+        start = 0
+        if self.archive.last_time is not None:
+            start = ot.searchsorted(self.archive.last_time, side="right")
+        if start == len(ot):
+            return
+        rows = klines.view("Open Time").searchsorted(ot[start:])
+        columns = {name: indicators.view(name)[start:] for name in PMAX_COLUMNS}
+        for name in ("Open", "High", "Low", "Close", "Volume", "VolumeCcy"):
+            columns[name] = klines.view(name)[rows]
+        self.archive.append(columns)
 
     def count_ratio(self, klines: DataFrame, side: str) -> float:
         row = klines.iloc[-2]
@@ -231,7 +250,7 @@ class Task:
         ratio_list: List[float] = []
         ratio_list.append(self.count_ratio(klines, side))
         for bar in self.avg_adx_ratio:
-            d = await self.candles(instId=self.id, bar=bar, limt=100)
+            d = await self.client.candles(instId=self.id, bar=bar, limt=100)
             if d["code"] != "0":
                 raise Exception("count_avg_ratio get kline code not 0. " + str(d))
             klines = DataFrame(
@@ -257,7 +276,7 @@ class Task:
 
         return ratio_sum / rll
 
-    def count_sz(self, price: float, ctVal: float, lever: int) -> Union[int, float]:
+    def count_sz(self, price: float, ctVal: float, lever: int) -> str:
         min_margin = self.min_margin
         max_margin = self.max_margin
         sz = (
@@ -266,12 +285,8 @@ class Task:
             / ctVal
             * lever
         )
-        minisz = (float)(self.instruments["minSz"])
-        if sz < minisz:
-            sz = minisz
-        sz = round_step_size(sz, ((float)(self.instruments["lotSz"])))
-        sz = int(sz) if sz.is_integer() else sz
-        return sz
+        lots = max(self.precision.lots(sz, ROUND_DOWN), self.precision.min_lots)
+        return self.precision.format_size(lots)
 
     def count_lever(self, min, max) -> int:
 
@@ -280,9 +295,7 @@ class Task:
 
     async def get_lever(self) -> int:
         return (int)(
-            (await self.client.get_leverage_info(self.id, MGN_MODE_CROSS))["data"][0][
-                "lever"
-            ]
+            (await self.client.metadata.leverage(self.id, MGN_MODE_CROSS))[0]["lever"]
         )
 
     async def set_lever(self, lever: int):
@@ -297,6 +310,10 @@ class Task:
                 self.logger.warning(f"Change lever failed. Msg: {str(d)}")
 
     async def refresh_positions(self):
+        if self.account is not None and self.account.live:
+            positions = self.account.position(self.id)
+            self.positions = dict(EMPTY_POSITIONS) if positions is None else positions
+            return
         d = await self.client.get_positions(self.inst_type, self.id)
         if d["code"] == "51030" and self.inst_type == INST_TYPE_SWAP:
             return
@@ -304,54 +321,15 @@ class Task:
             self.logger.warning(f"refresh_positions failed. Msg: {str(d)}")
             return
         if len(d["data"]) == 0:
-            self.positions = {
-                "adl": "",
-                "availPos": "",
-                "avgPx": "",
-                "cTime": "",
-                "ccy": "",
-                "deltaBS": "",
-                "deltaPA": "",
-                "gammaBS": "",
-                "gammaPA": "",
-                "imr": "",
-                "instId": "",
-                "instType": "",
-                "interest": "0",
-                "last": "",
-                "lever": "",
-                "liab": "",
-                "liabCcy": "",
-                "liqPx": "",
-                "margin": "",
-                "markPx": "",
-                "mgnMode": "",
-                "mgnRatio": "",
-                "mmr": "",
-                "notionalUsd": "",
-                "optVal": "",
-                "pos": "",
-                "posCcy": "",
-                "posId": "",
-                "posSide": "",
-                "thetaBS": "",
-                "thetaPA": "",
-                "tradeId": "",
-                "uTime": "",
-                "upl": "",
-                "uplRatio": "",
-                "usdPx": "",
-                "vegaBS": "",
-                "vegaPA": "",
-            }
+            self.positions = dict(EMPTY_POSITIONS)
         else:
             self.positions = d["data"][0]
 
-    def get_side(self, klines: DataFrame) -> str:
-        row2 = klines.iloc[-2]
+    def get_side(self, indicators: KlineStore) -> str:
+        row2 = indicators.row(-1)
         # self.logger.debug(f"{str(row2)}")
 
-        row3 = klines.iloc[-3]
+        row3 = indicators.row(-2)
         side = None
         if row3["PMax_dir"] != row2["PMax_dir"]:
             side = pmaxdir_to_posside(row2["PMax_dir"])
@@ -359,9 +337,14 @@ class Task:
             side = None
         return side
 
-    async def get_price(self, side: str = None) -> int:
-        ticksz = (float)(self.instruments["tickSz"])
-        ticker = (await self.client.get_ticker(self.id))["data"][0]
+    @TASK_STAGE.timed("get_price")
+    async def get_price(self, side: str = None) -> Union[float, str]:
+        """The last price, or with a side the limit price to order at, rounded
+        to the tick away from the spread side it crosses."""
+        ticksz = self.precision.tick
+        ticker = self.feed.ticker(self.id) if self.feed is not None else None
+        if ticker is None:
+            ticker = (await self.client.get_ticker(self.id))["data"][0]
 
         bid = (float)(ticker["bidPx"])
         ask = (float)(ticker["askPx"])
@@ -373,8 +356,11 @@ class Task:
         price = bid if side == SIDE_BUY else ask
         if ab > (ticksz * 2):
             price = price + ab2 if side == SIDE_BUY else price - ab2
-        return round_step_size((price + last) / 2, ticksz)
+        return self.precision.price(
+            (price + last) / 2, ROUND_DOWN if side == SIDE_BUY else ROUND_UP
+        )
 
+    @TASK_STAGE.timed("create_order_wait_filled")
     async def create_order_wait_filled(
         self,
         tdMode: str,
@@ -390,19 +376,24 @@ class Task:
         self.logger.debug(
             f"Create order wait filled. id:{id}, tdMode:{tdMode}, side:{side}, ordType:{ordType}, sz:{sz}, posSide:{posSide}, px:{px}"
         )
-        d = (await client.order(id, tdMode, side, ordType, sz, posSide, px))["data"][0]
+        d = await client.order_coalesced(id, tdMode, side, ordType, sz, posSide, px)
         if d["sCode"] != "0":
             self.logger.warning(f"Create order failed. {str(d)}")
             return False
         orderid = d["ordId"]
-        for _ in range(5):
-            await asyncio.sleep(1)
-
-            status = (await client.get_order(id, orderid))["data"][0]["state"]
-            if status == "filled":
+        if self.account is not None and self.account.live:
+            order = await self.account.wait_order(orderid, timeout=5)
+            if order is not None and order["state"] == ORDER_STATE_FILLED:
                 return True
+        else:
+            for _ in range(5):
+                await asyncio.sleep(1)
+
+                status = (await client.get_order(id, orderid))["data"][0]["state"]
+                if status == ORDER_STATE_FILLED:
+                    return True
         self.logger.warning(f"Wait order filled timeout, Chanel order")
-        d = (await client.cancel_order(id, orderid))["data"][0]
+        d = await client.cancel_order_coalesced(id, orderid)
         if d["sCode"] != "0":
             self.logger.warning(f"Chanel order failed. {str(d)}")
 
@@ -442,13 +433,13 @@ class Task:
             (await self.get_price(coside)),
         )
 
-    async def sub_sz(self, klines: DataFrame):
-        row = klines.iloc[-2]
+    async def sub_sz(self, indicators: KlineStore):
+        row = indicators.row(-1)
 
         posside = self.positions["posSide"]
         if pmaxdir_to_posside(row["PMax_dir"]) != posside:
             return
-        opents = pd.Timestamp(row["Open Time"]).timestamp()
+        opents = row["Open Time"] / 1000
         if opents <= self.last_sub_sz_time and self.last_sub_sz_time != 0:
             return
         hl2 = row["hl2"]
@@ -459,7 +450,6 @@ class Task:
             return
         availPos = float(self.positions["availPos"])
         avgPx = float(self.positions["avgPx"])
-        minsz = float(self.instruments["minSz"])
         subsz = 0.0
         if (posside == POS_SIDE_LONG and hl2 < avgPx) or (
             posside == POS_SIDE_SHORT and hl2 > avgPx
@@ -469,12 +459,14 @@ class Task:
             subsz = availPos * abs(hl2 - pm) / abs(pm - avgPx)
             logger.debug(f"SubSZ by ratio {abs(hl2 - pm) / abs(pm - avgPx)}")
 
-        subsz = minsz if subsz < minsz else subsz
-        subsz = availPos - minsz if availPos - subsz < minsz else subsz
-        subsz = round_step_size(subsz, step_size=float(self.instruments["lotSz"]))
-        if subsz <= 0:
+        precision = self.precision
+        avail_lots = precision.lots(availPos, ROUND_DOWN)
+        sub_lots = max(precision.lots(subsz, ROUND_DOWN), precision.min_lots)
+        if avail_lots - sub_lots < precision.min_lots:
+            sub_lots = avail_lots - precision.min_lots
+        if sub_lots <= 0:
             return
-        subsz = int(subsz) if subsz.is_integer() else subsz
+        subsz = precision.format_size(sub_lots)
         self.logger.debug(f"Sub sz {subsz}")
         coside = SIDE_SELL if posside == POS_SIDE_LONG else SIDE_BUY
 
@@ -490,14 +482,19 @@ class Task:
 
     async def __run(self):
 
-        await self.refresh_positions()
+        with TASK_STAGE.time("refresh_positions"):
+            await self.refresh_positions()
 
-        klines = await self.get_thousand_kline()
+        with TASK_STAGE.time("get_thousand_kline"):
+            klines = await self.get_thousand_kline()
 
-        klines = self.init_indicators(klines)
-        klines.to_csv(f"klines/{self.id}_{self.bar}.csv", sep="\t", encoding="utf-8")
+        with TASK_STAGE.time("init_indicators"):
+            indicators = await self.init_indicators(klines)
+        with TASK_STAGE.time("archive_bars"):
+            self.archive_bars(klines, indicators)
 
-        side = self.get_side(klines)
+        with TASK_STAGE.time("get_side"):
+            side = self.get_side(indicators)
 
         if side != None:
             """
@@ -509,9 +506,14 @@ class Task:
             await self.set_lever(lever=lever)
             """
             self.logger.debug(f"New side {side}")
-            await self.change_side(side)
+            with TASK_STAGE.time("change_side"):
+                await self.change_side(side)
         """elif self.positions["availPos"] != "":
-            await self.sub_sz(klines)"""
+            await self.sub_sz(indicators)"""
+
+    async def step(self):
+        """One run() that raises instead of logging, for the backtester."""
+        await self.__run()
 
     async def run(self):
         try: